@@ -0,0 +1,337 @@
+from __future__ import annotations
+
+import argparse
+import os
+import pathlib
+import random
+import tempfile
+import time
+
+from header import SectionHeader
+from file_class import HeaderSpecifier, HeaderScanner
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 1
+# section_description: LegacyParser
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+class LegacyHeaderParser:
+    """Per character state machine that parse_master_file_headers used
+    before SectionHeader.compile, kept as the baseline for comparison"""
+
+    def __init__(self, section_header : SectionHeader) -> None:
+
+        # The header sequence specifies the position
+        # in standard_header_sequence that is being
+        # parsed for
+
+        self.section_header = section_header
+        self.last_head_sq_index = len(section_header.key_sequence) - 1
+
+        self.head_sq_index = 0
+        self.parsing_header = False
+        self.header_lines : list[str] = []
+        self.header_specifiers : list[HeaderSpecifier] = []
+        self.new_header_specifier : HeaderSpecifier = None
+
+        self.section_number = None
+        self.section_description = None
+
+    @property
+    def idle(self) -> bool:
+        """True when no header is partially matched"""
+        return self.head_sq_index == 0
+
+    def feed_code_line(self, line_num : int, line : str) -> None:
+        """Record a line already known not to start or continue a header"""
+
+        if self.new_header_specifier is not None and line.strip():
+
+            if self.new_header_specifier.code_start_line is None:
+                self.new_header_specifier.code_start_line = line_num
+
+            self.new_header_specifier.code_end_line = line_num
+
+        self.header_lines = []
+
+    def feed(self, line_num : int, line : str) -> None:
+
+        key_sequence = self.section_header.key_sequence
+        key_number = self.section_header.key_number
+        key_description = self.section_header.key_description
+
+        index_char = 0
+        header_parse_success = False
+        pulse_last_head_sq_index = False
+
+        # Parse the entire line, which could contain
+        # several header sequence elements
+        while index_char < len(line):
+            current_header_sequence_string = key_sequence[self.head_sq_index]
+            test_string = line[index_char : index_char + len(current_header_sequence_string)]
+            header_sequence_match = test_string == current_header_sequence_string
+            pulse_last_head_sq_index = self.last_head_sq_index == self.head_sq_index
+            header_parse_success = False
+
+            # Header text match
+            if header_sequence_match:
+                index_char += len(current_header_sequence_string)
+                header_parse_success = True
+
+            # Header sequence number
+            if current_header_sequence_string == key_number:
+
+                parse_key = False
+
+                # Get the section number as string
+                if pulse_last_head_sq_index:
+                    section_number_str = line[index_char:].strip()
+                    parse_key = True
+
+                else:
+                    next_test_string = key_sequence[self.head_sq_index + 1]
+                    try:
+                        next_test_string_index = line[index_char:].index(next_test_string)
+                    except:
+                        pass
+                    else:
+                        section_number_str = line[index_char:][:next_test_string_index].strip()
+                        parse_key = True
+
+                if parse_key:
+                    try:
+                        self.section_number = int(section_number_str)
+                    except:
+                        pass
+                    else:
+                        header_parse_success = True
+                        index_char += len(section_number_str)
+
+            # Header sequence description
+            if current_header_sequence_string == key_description:
+
+                # Get the section number as string
+                if pulse_last_head_sq_index:
+                    self.section_description = line[index_char:].strip()
+                    header_parse_success = True
+
+                else:
+                    next_test_string = key_sequence[self.head_sq_index + 1]
+                    try:
+                        next_test_string_index = line[index_char:].index(next_test_string)
+                    except:
+                        pass
+                    else:
+                        self.section_description = line[index_char:][:next_test_string_index].strip()
+                        header_parse_success = True
+                        index_char += len(self.section_description)
+
+            # Increment header sequence index
+            # or reset if header parsing failure
+            if header_parse_success:
+                self.head_sq_index += 1
+                if pulse_last_head_sq_index:
+
+                    self.head_sq_index = 0
+                    index_char = len(line)
+
+                    self.header_lines.append(line)
+
+                    # The previous section ends where this header starts
+                    if self.new_header_specifier is not None:
+                        self.header_specifiers.append(self.new_header_specifier)
+
+                    self.new_header_specifier = HeaderSpecifier(
+                        header_start_line= line_num - len(self.header_lines) + 1,
+                        header_end_line= line_num,
+                        section_description= self.section_description,
+                        section_number= self.section_number
+                    )
+
+            else:
+                self.head_sq_index = 0
+                index_char = len(line)
+
+                if self.new_header_specifier is not None:
+
+                    if line.strip() and self.new_header_specifier.code_start_line is None:
+                        self.new_header_specifier.code_start_line = line_num
+
+                    if line.strip():
+                        self.new_header_specifier.code_end_line = line_num
+
+        if not self.parsing_header:
+            self.header_lines = []
+
+        if header_parse_success and not pulse_last_head_sq_index:
+            self.parsing_header = True
+            self.header_lines.append(line.strip())
+
+        elif self.parsing_header:
+
+            self.parsing_header = False
+            self.header_lines = []
+
+    def finish(self) -> list[HeaderSpecifier]:
+
+        if self.new_header_specifier is not None:
+            self.header_specifiers.append(self.new_header_specifier)
+            self.new_header_specifier = None
+
+        return self.header_specifiers
+
+def parse_legacy(path : pathlib.Path, section_header : SectionHeader) -> list[HeaderSpecifier]:
+
+    parser = LegacyHeaderParser(section_header)
+
+    with open(path, "r") as f:
+        for line_num, line in enumerate(f):
+            parser.feed(line_num, line)
+
+    return parser.finish()
+
+def parse_compiled_lines(path : pathlib.Path, section_header : SectionHeader) -> list[HeaderSpecifier]:
+
+    with open(path, "rb") as f:
+        return HeaderScanner([section_header]).scan_lines(f).get(section_header, [])
+
+def parse_compiled_text(path : pathlib.Path, section_header : SectionHeader) -> list[HeaderSpecifier]:
+    return HeaderScanner([section_header]).scan(path).get(section_header, [])
+
+parsers = {
+    "legacy": parse_legacy,
+    "compiled lines": parse_compiled_lines,
+    "compiled text": parse_compiled_text
+}
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 2
+# section_description: SyntheticFiles
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+benchmark_header = SectionHeader(
+    key_sequence= [
+        "# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n",
+        "# section number     : ",
+        "___number___",
+        "\n",
+        "# section description: ",
+        "___description___",
+        "\n",
+        "# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"
+    ],
+    key_number="___number___",
+    key_description="___description___"
+)
+
+def generate_master_file(
+        path : pathlib.Path,
+        section_header : SectionHeader,
+        size_bytes : int,
+        lines_per_section : int = 40,
+        line_length : int = 60,
+        seed : int = 0,
+        section_count : int = None
+    ) -> int:
+    """Write a master file of roughly size_bytes, or of section_count
+    sections if given, returning the section count"""
+
+    rng = random.Random(seed)
+    rule_line = section_header.key_sequence[0]
+
+    written = 0
+    section_number = 0
+
+    with open(path, "w") as f:
+        while written < size_bytes if section_count is None else section_number < section_count:
+
+            section_number += 1
+            chunk = [section_header.generate_header(number= section_number, description= f"section_{section_number}"), "\n\n"]
+
+            for _ in range(lines_per_section):
+                roll = rng.random()
+                if roll < 0.1:
+                    chunk.append("\n")
+                elif roll < 0.12:
+                    # Stray rule lines start a header that never completes
+                    chunk.append(rule_line)
+                else:
+                    indent = " " * rng.randrange(0, 12, 4)
+                    chunk.append(indent + "x" * rng.randrange(1, line_length) + "\n")
+
+            text = "".join(chunk)
+            f.write(text)
+            written += len(text)
+
+    return section_number
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 3
+# section_description: Main
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+def line_fields(header_specifier : HeaderSpecifier) -> tuple:
+
+    return (
+        header_specifier.header_start_line,
+        header_specifier.header_end_line,
+        header_specifier.code_start_line,
+        header_specifier.code_end_line,
+        header_specifier.section_number,
+        header_specifier.section_description
+    )
+
+def time_parser(parse, path : pathlib.Path, section_header : SectionHeader, repeat : int) -> tuple[float, list[HeaderSpecifier]]:
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        header_specifiers = parse(path, section_header)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best, header_specifiers
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description= "Compare the legacy and compiled header parsers.")
+    parser.add_argument("--sizes", type= float, nargs= "+", default= [1, 4, 16],
+                        help= "master file sizes in MB")
+    parser.add_argument("--lines-per-section", type= int, default= 200,
+                        help= "code lines generated after each header")
+    parser.add_argument("--repeat", type= int, default= 3,
+                        help= "runs per parser, the best is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dir_temp:
+
+        print(f"{'size MB':>8} {'sections':>9}" + "".join(f" {name + ' s':>17}" for name in parsers) + f" {'speedup':>8}")
+
+        for size in args.sizes:
+            path = pathlib.Path(dir_temp).joinpath(f"master_{size}.py")
+            section_count = generate_master_file(
+                path,
+                benchmark_header,
+                int(size * 1024 * 1024),
+                lines_per_section= args.lines_per_section
+            )
+
+            times = {}
+            results = {}
+            for name, parse in parsers.items():
+                times[name], results[name] = time_parser(parse, path, benchmark_header, args.repeat)
+
+            # The legacy parser only knows line numbers
+            expected = [line_fields(h) for h in results["legacy"]]
+            for name, result in results.items():
+                if [line_fields(h) for h in result] != expected:
+                    raise SystemExit(f"{name} parser disagrees with legacy on {path.name}")
+
+            if [h.as_tuple() for h in results["compiled lines"]] != [h.as_tuple() for h in results["compiled text"]]:
+                raise SystemExit(f"compiled parsers disagree on byte offsets in {path.name}")
+
+            speedup = times["legacy"] / times["compiled text"]
+            print(f"{size:>8} {section_count:>9}" + "".join(f" {t:>17.3f}" for t in times.values()) + f" {speedup:>7.1f}x")
+
+            os.remove(path)
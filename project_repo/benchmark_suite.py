@@ -0,0 +1,334 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import pathlib
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from header import SectionHeader
+from file_class import MasterFile, parse_master_file_headers
+from benchmark import generate_master_file
+import sectioner
+from service import SectionerService
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 1
+# section_description: Matrix
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+dialects = {
+    "python": sectioner.python_header,
+    "st": sectioner.st_header
+}
+
+def lines_per_section_for(
+        section_header : SectionHeader,
+        size_bytes : int,
+        section_count : int,
+        line_length : int
+    ) -> int:
+    """Code lines per section that make generate_master_file write about
+    section_count sections in size_bytes, or None when even empty
+    sections would not fit"""
+
+    header_bytes = len(section_header.generate_header(number= section_count, description= f"section_{section_count}")) + 2
+
+    # Mirrors the mix of lines generate_master_file writes
+    average_line = .1 * 1 + .02 * len(section_header.key_sequence[0]) + .88 * (4 + line_length / 2 + 1)
+
+    room = size_bytes / section_count - header_bytes
+    if room < 0:
+        return None
+
+    return int(room / average_line)
+
+def parse_size(text : str) -> int:
+    """Bytes from 512, 64K, 16M or 1G"""
+
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+
+    return int(text)
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 2
+# section_description: Measures
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+def best_of(repeat : int, run, setup = None) -> float:
+
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def time_change_to_sync(master_file : MasterFile, repeat : int, use_inotify : bool) -> float:
+    """Seconds from appending a line to the master file until the
+    service has rebuilt its sections, debounce included"""
+
+    async def run() -> float:
+
+        synced = asyncio.Event()
+
+        def sync(master_file, use_mmap, fsync):
+            result = sectioner.sync_master_file(master_file, use_mmap, fsync)
+            loop.call_soon_threadsafe(synced.set)
+            return result
+
+        loop = asyncio.get_running_loop()
+        best = None
+
+        async with SectionerService([master_file], use_inotify= use_inotify, sync= sync):
+            for i in range(repeat):
+                synced.clear()
+
+                start = time.perf_counter()
+                with open(master_file.path, "a") as f:
+                    f.write(f"# change {i}\n")
+
+                await asyncio.wait_for(synced.wait(), timeout= 60)
+
+                elapsed = time.perf_counter() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+
+                # Let the syncs the rebuild's own writes cause settle first
+                await asyncio.sleep(.2)
+
+        return best
+
+    return asyncio.run(run())
+
+def run_cell(
+        dir_cell : pathlib.Path,
+        dialect : str,
+        size_bytes : int,
+        section_count : int,
+        line_length : int,
+        repeat : int,
+        use_inotify : bool
+    ) -> dict:
+
+    section_header = dialects[dialect]
+    lines_per_section = lines_per_section_for(section_header, size_bytes, section_count, line_length)
+    if lines_per_section is None:
+        return None
+
+    dir_cell.mkdir(parents= True)
+    path = dir_cell.joinpath("master.txt")
+
+    start = time.perf_counter()
+    sections = generate_master_file(
+        path,
+        section_header,
+        size_bytes,
+        lines_per_section= lines_per_section,
+        line_length= line_length,
+        section_count= section_count
+    )
+    generate_seconds = time.perf_counter() - start
+
+    times = {}
+
+    times["discovery"] = best_of(repeat, lambda: sectioner.get_master_files(
+        [str(dir_cell)], sectioner.all_section_headers
+    ))
+
+    master_file = sectioner.get_master_files([str(dir_cell)], sectioner.all_section_headers)[0]
+
+    times["parse"] = best_of(repeat, lambda: parse_master_file_headers(master_file))
+
+    master_file.parse()
+    times["generate_cold"] = best_of(
+        repeat,
+        lambda: sectioner.generate_section_files(master_file),
+        setup= lambda: shutil.rmtree(master_file.dir_master_sections, ignore_errors= True)
+    )
+    times["generate_unchanged"] = best_of(repeat, lambda: sectioner.generate_section_files(master_file))
+
+    times["change_to_sync"] = time_change_to_sync(master_file, repeat, use_inotify)
+
+    generated_size = os.path.getsize(path)
+    shutil.rmtree(dir_cell)
+
+    return {
+        "dialect": dialect,
+        "size_bytes": generated_size,
+        "target_size_bytes": size_bytes,
+        "target_sections": section_count,
+        "sections": sections,
+        "line_length": line_length,
+        "generate_file_seconds": generate_seconds,
+        "seconds": times
+    }
+
+def cell_key(result : dict) -> tuple:
+    return result["dialect"], result["target_size_bytes"], result["target_sections"], result["line_length"]
+
+def regressions(results : list[dict], baseline : list[dict], tolerance : float) -> list[str]:
+    """Measures more than tolerance times slower than in baseline"""
+
+    baseline_cells = {cell_key(result): result for result in baseline}
+
+    found = []
+    for result in results:
+        previous = baseline_cells.get(cell_key(result))
+        if previous is None:
+            continue
+
+        for measure, seconds in result["seconds"].items():
+            previous_seconds = previous["seconds"].get(measure)
+            if previous_seconds and seconds > previous_seconds * tolerance:
+                found.append(f"{cell_key(result)} {measure}: {previous_seconds:.4f}s -> {seconds:.4f}s")
+
+    return found
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 3
+# section_description: Startup
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+# Modules an editor hook pays for on every short run
+startup_modules = ("sectioner",)
+
+def time_import(module : str, repeat : int) -> float:
+    """Best seconds to import module in a fresh interpreter,
+    with nothing else imported beforehand"""
+
+    code = (
+        "import time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(time.perf_counter() - start)\n"
+    )
+
+    best = None
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd= os.path.dirname(os.path.abspath(__file__)),
+            capture_output= True,
+            text= True,
+            check= True
+        ).stdout
+
+        elapsed = float(output.split()[-1])
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 4
+# section_description: Main
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description= "Time discovery, parsing, section generation and sync over synthetic master files.")
+    parser.add_argument("--sizes", type= parse_size, nargs= "+", default= [parse_size("64K"), parse_size("1M"), parse_size("16M")],
+                        help= "master file sizes, like 64K, 16M or 1G")
+    parser.add_argument("--sections", type= int, nargs= "+", default= [1, 100, 10000],
+                        help= "section counts, cells where they do not fit the size are skipped")
+    parser.add_argument("--dialects", nargs= "+", choices= list(dialects), default= list(dialects),
+                        help= "header dialects")
+    parser.add_argument("--line-lengths", type= int, nargs= "+", default= [60],
+                        help= "longest generated code line")
+    parser.add_argument("--repeat", type= int, default= 3,
+                        help= "runs per measure, the best is reported")
+    parser.add_argument("--poll", action= "store_true",
+                        help= "time change to sync with the polling watcher instead of inotify")
+    parser.add_argument("--output", type= str, default= None,
+                        help= "write results as JSON here instead of to stdout")
+    parser.add_argument("--baseline", type= str, default= None,
+                        help= "earlier JSON results to compare against, exits 1 on a regression")
+    parser.add_argument("--tolerance", type= float, default= 1.25,
+                        help= "how many times slower than the baseline counts as a regression")
+    parser.add_argument("--dir", type= str, default= None,
+                        help= "where to generate files, a temporary directory by default")
+    parser.add_argument("--import-budget", type= float, default= None,
+                        help= "milliseconds importing each startup module may take, exits 1 when one takes longer")
+    args = parser.parse_args()
+
+    import_seconds = {module: time_import(module, max(args.repeat, 5)) for module in startup_modules}
+    for module, seconds in import_seconds.items():
+        print(f"import {module} {seconds * 1000:.1f}ms", file= sys.stderr)
+
+    results = []
+
+    with tempfile.TemporaryDirectory(dir= args.dir) as dir_temp:
+
+        matrix = itertools.product(args.dialects, args.sizes, args.sections, args.line_lengths)
+        for index, (dialect, size_bytes, section_count, line_length) in enumerate(matrix):
+
+            result = run_cell(
+                pathlib.Path(dir_temp).joinpath(str(index)),
+                dialect,
+                size_bytes,
+                section_count,
+                line_length,
+                args.repeat,
+                use_inotify= not args.poll
+            )
+            if result is None:
+                print(f"skipped {dialect} {size_bytes} bytes {section_count} sections: sections do not fit", file= sys.stderr)
+                continue
+
+            print(
+                f"{dialect:>7} {result['size_bytes']:>12} bytes {result['sections']:>7} sections "
+                + " ".join(f"{measure} {seconds:.4f}s" for measure, seconds in result["seconds"].items()),
+                file= sys.stderr
+            )
+            results.append(result)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.time(),
+        "repeat": args.repeat,
+        "import_seconds": import_seconds,
+        "results": results
+    }
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent= 2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent= 2)
+
+    found = []
+
+    if args.import_budget is not None:
+        for module, seconds in import_seconds.items():
+            if seconds * 1000 > args.import_budget:
+                found.append(f"import {module}: {seconds * 1000:.1f}ms over the {args.import_budget:g}ms budget")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            found += regressions(results, json.load(f)["results"], args.tolerance)
+
+    for line in found:
+        print(f"regression {line}", file= sys.stderr)
+
+    if found:
+        raise SystemExit(1)
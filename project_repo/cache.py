@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import hashlib
+import marshal
+import os
+from pathlib import Path
+
+from header import SectionHeader
+from file_class import MasterFile, SectionTable
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 1
+# section_description: ParseCache
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+def user_cache_dir() -> Path:
+    """The user's cache directory, XDG_CACHE_HOME or ~/.cache,
+    LOCALAPPDATA on Windows"""
+
+    base = os.environ.get("XDG_CACHE_HOME")
+    if not base and os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+
+    return Path(base, "filesectioner")
+
+def default_cache_path(directories : list[str]) -> Path:
+    """Cache file for a run over directories, in user_cache_dir rather than
+    any of them. Each set of directories gets a file of its own, so runs over
+    different trees neither load nor prune each other's entries."""
+
+    digest = hashlib.blake2b(digest_size= 8)
+    for directory in sorted({str(Path(directory).resolve()) for directory in directories}):
+        digest.update(os.fsencode(directory) + b"\0")
+
+    return user_cache_dir().joinpath(f"parse_cache_{digest.hexdigest()}")
+
+class ParseCache:
+    """Header scan results kept on disk between runs
+
+    Entries are keyed by path and only used while the file's size,
+    st_mtime_ns and inode are what they were when it was scanned. Files
+    without headers are cached too, so on a warm start most files cost
+    a single stat. The whole cache is dropped if the set of headers
+    being scanned for changes, since that changes every result.
+
+    Stored with marshal as plain tuples, entries are
+    (size, st_mtime_ns, inode, header fingerprint or None,
+    SectionTable.to_stored columns, section digests, master digest or None).
+    The master digest lets a warm start tell a touch from an edit.
+    """
+
+    format_version = 3
+
+    def __init__(self, path : Path, headers : list[SectionHeader]) -> None:
+
+        self.path = Path(path)
+        self.headers = {header.fingerprint(): header for header in headers}
+
+        digest = hashlib.blake2b(digest_size= 8)
+        for fingerprint in self.headers:
+            digest.update(fingerprint.encode())
+        self.headers_fingerprint = digest.hexdigest()
+
+        self.entries : dict[str, tuple] = {}
+        self.seen : set[str] = set()
+        self.dirty = False
+
+    def load(self) -> None:
+
+        try:
+            with open(self.path, "rb") as f:
+                stored = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+
+        if not isinstance(stored, dict) \
+            or stored.get("version") != self.format_version \
+            or stored.get("headers") != self.headers_fingerprint:
+                self.dirty = True
+                return
+
+        self.entries = stored.get("entries", {})
+
+    def save(self) -> None:
+
+        if not self.dirty:
+            return
+
+        stored = {
+            "version": self.format_version,
+            "headers": self.headers_fingerprint,
+            "entries": self.entries
+        }
+
+        os.makedirs(self.path.parent, exist_ok= True)
+
+        temporary_path = self.path.with_name(self.path.name + ".tmp")
+        with open(temporary_path, "wb") as f:
+            marshal.dump(stored, f)
+
+        os.replace(temporary_path, self.path)
+        self.dirty = False
+
+    def lookup(
+            self,
+            path : Path,
+            identity : tuple[int, int, int]
+        ) -> tuple[SectionHeader, SectionTable, dict[str, tuple[int, int, bytes]], bytes]:
+        """Cached (header, header specifiers, section digests, digest) for the
+        file, header being None for files without headers, or None on a miss"""
+
+        key = str(path)
+        self.seen.add(key)
+
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        # The file changed since it was cached
+        if tuple(entry[:3]) != tuple(identity):
+            del self.entries[key]
+            self.dirty = True
+            return None
+
+        fingerprint, header_specifiers, section_digests, digest = entry[3:]
+        if fingerprint is None:
+            return None, SectionTable(), {}, None
+
+        header = self.headers.get(fingerprint)
+        if header is None:
+            return None
+
+        return (
+            header,
+            SectionTable.from_stored(header_specifiers),
+            dict(section_digests),
+            digest
+        )
+
+    def store(
+            self,
+            path : Path,
+            identity : tuple[int, int, int],
+            header : SectionHeader = None,
+            header_specifiers : SectionTable = None,
+            section_digests : dict[str, tuple[int, int, bytes]] = None,
+            digest : bytes = None
+        ) -> None:
+
+        if identity is None:
+            return
+
+        key = str(path)
+        self.seen.add(key)
+        self.entries[key] = (
+            *identity,
+            header.fingerprint() if header is not None else None,
+            (header_specifiers or SectionTable()).to_stored(),
+            dict(section_digests or {}),
+            digest
+        )
+        self.dirty = True
+
+    def store_master(self, master_file : MasterFile) -> None:
+        """Cache a master file as last parsed, with the section files it last
+        wrote, and its digest when its change state has one for that content"""
+
+        identity = master_file.header_identity
+        state = master_file.prev_state
+        digest = state[2] if identity is not None and state is not None and state[:2] == identity[:2] else None
+
+        self.store(
+            path= master_file.path,
+            identity= master_file.header_identity,
+            header= master_file.section_header,
+            header_specifiers= master_file.header_specifiers,
+            section_digests= master_file.section_digests,
+            digest= digest
+        )
+
+    def prune(self) -> None:
+        """Evict entries for files that no longer exist"""
+
+        for key in list(self.entries):
+            if key not in self.seen and not os.path.exists(key):
+                del self.entries[key]
+                self.dirty = True
@@ -0,0 +1,341 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import queue
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+from file_class import MasterFile
+from instrumentation import metrics
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 1
+# section_description: Shard
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+def shard_of(path : Path, shards : int) -> int:
+    """Shard a master file belongs to, the same in every process and run"""
+
+    digest = hashlib.blake2b(os.fsencode(str(path)), digest_size= 8).digest()
+    return int.from_bytes(digest, "little") % shards
+
+def run_shard(
+        shard : int,
+        master_files : list[MasterFile],
+        commands,
+        reports,
+        use_mmap : bool = False,
+        fsync : str = "none",
+        stream : bool = False,
+        use_inotify : bool = True,
+        poll_interval : float = .1,
+        health_interval : float = 1.,
+        change_detection : str = "digest",
+        metrics_enabled : bool = False
+    ) -> None:
+    """Worker process of one shard. Builds the stale sections of its master
+    files, then keeps them in sync with a SectionerService until told to stop.
+
+    commands brings ("add", master_file), ("remove", path) and ("stop", None).
+    reports takes ("health", shard, status) every health_interval seconds,
+    and ("stopped", shard, master_files) last, for the coordinator to cache.
+    With metrics_enabled, ("metrics", shard, taken) comes before each of
+    them, with the shard's metrics since the last, see Instrumentation.take."""
+
+    import asyncio
+    import functools
+    import signal
+    import threading
+
+    from file_class import MonitoredFile, change_detectors
+    from sectioner import build_stale_sections, sync_master_file
+    from service import SectionerService
+
+    # Ctrl-C reaches the whole process group, the coordinator stops the shards
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    MonitoredFile.change_detector = change_detectors[change_detection]
+
+    if metrics_enabled:
+        metrics.enable()
+
+    def report(kind : str, value) -> None:
+        if metrics_enabled:
+            reports.put(("metrics", shard, metrics.take()))
+        reports.put((kind, shard, value))
+
+    build_stale_sections(master_files, use_mmap= use_mmap, fsync= fsync, stream= stream)
+
+    async def serve() -> list[MasterFile]:
+
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+
+        service = SectionerService(
+            master_files= master_files,
+            use_mmap= use_mmap,
+            fsync= fsync,
+            poll_interval= poll_interval,
+            use_inotify= use_inotify,
+            sync= functools.partial(sync_master_file, stream= stream) if stream else sync_master_file
+        )
+
+        def handle(kind : str, value) -> None:
+
+            if kind == "add":
+                loop.create_task(service.add(value))
+
+            elif kind == "remove":
+                for master_file in service.master_files:
+                    if master_file.path == value:
+                        loop.create_task(service.remove(master_file))
+                        break
+
+            elif kind == "stop":
+                stopping.set()
+
+        def read_commands() -> None:
+            while True:
+                kind, value = commands.get()
+                loop.call_soon_threadsafe(handle, kind, value)
+                if kind == "stop":
+                    return
+
+        # Queue reads block, so they get a thread of their own
+        threading.Thread(target= read_commands, daemon= True).start()
+
+        async with service:
+            while not stopping.is_set():
+                report("health", {"pid": os.getpid(), "time": time.time(), **service.status()})
+                try:
+                    await asyncio.wait_for(stopping.wait(), health_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+        return service.master_files
+
+    report("stopped", asyncio.run(serve()))
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 2
+# section_description: ShardedDaemon
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+class ShardedDaemon:
+    """Keeps sections in sync from several worker processes, each with
+    the master files whose path hashes to it, see shard_of.
+
+    A slow rebuild then only holds up the masters of its own shard. The
+    coordinating process, the one that runs the daemon, does discovery:
+    every rescan_interval seconds it calls discover and hands master
+    files it has not seen before to their shards over per-shard command
+    queues. Shards report their SectionerService.status every
+    health_interval seconds, and a shard whose process dies is started
+    again with its master files. health() gives the latest reports,
+    which are also written to health_path as JSON when it is set.
+
+    While metrics are enabled, the shards' metrics are merged into this
+    process's as they are reported. Those of a shard since its last report
+    are lost if its process dies.
+    """
+
+    def __init__(
+            self,
+            master_files : list[MasterFile],
+            shards : int,
+            use_mmap : bool = False,
+            fsync : str = "none",
+            stream : bool = False,
+            use_inotify : bool = True,
+            poll_interval : float = .1,
+            health_interval : float = 1.,
+            health_path : Path = None,
+            discover : Callable[[], list[MasterFile]] = None,
+            rescan_interval : float = 10.,
+            change_detection : str = "digest"
+        ) -> None:
+
+        import multiprocessing
+
+        # Shards start from a fresh interpreter rather than a copy of this one
+        self.context = multiprocessing.get_context("spawn")
+
+        self.shards = shards
+        self.health_interval = health_interval
+        self.health_path = Path(health_path) if health_path is not None else None
+        self.discover = discover
+        self.rescan_interval = rescan_interval
+
+        self.shard_settings = {
+            "use_mmap": use_mmap,
+            "fsync": fsync,
+            "stream": stream,
+            "use_inotify": use_inotify,
+            "poll_interval": poll_interval,
+            "health_interval": health_interval,
+            "change_detection": change_detection,
+            "metrics_enabled": metrics.enabled
+        }
+
+        # Master files of each shard by path, as last handed to it
+        self.shard_masters : list[dict[Path, MasterFile]] = [{} for _ in range(shards)]
+        for master_file in master_files:
+            self.shard_masters[shard_of(master_file.path, shards)][master_file.path] = master_file
+
+        self.processes : list = [None] * shards
+        self.commands : list = [None] * shards
+        self.reports = self.context.Queue()
+
+        self.restarts = [0] * shards
+        self.latest : list[dict] = [None] * shards
+        self.last_report : list[float] = [None] * shards
+
+        # Master files sent back by stopped shards
+        self.stopped : dict[int, list[MasterFile]] = {}
+
+    def start_shard(self, shard : int) -> None:
+
+        self.commands[shard] = self.context.Queue()
+        process = self.context.Process(
+            target= run_shard,
+            name= f"filesectioner-shard-{shard}",
+            args= (shard, list(self.shard_masters[shard].values()), self.commands[shard], self.reports),
+            kwargs= self.shard_settings,
+            daemon= True
+        )
+        process.start()
+        self.processes[shard] = process
+        self.last_report[shard] = time.monotonic()
+
+    def start(self) -> None:
+        for shard in range(self.shards):
+            self.start_shard(shard)
+
+    def add(self, master_file : MasterFile) -> None:
+        """Hand a master file to its shard, unless it has it already"""
+
+        shard = shard_of(master_file.path, self.shards)
+        if master_file.path in self.shard_masters[shard]:
+            return
+
+        self.shard_masters[shard][master_file.path] = master_file
+        self.commands[shard].put(("add", master_file))
+
+    def remove(self, path : Path) -> None:
+
+        shard = shard_of(path, self.shards)
+        if self.shard_masters[shard].pop(path, None) is not None:
+            self.commands[shard].put(("remove", path))
+
+    def rescan(self) -> None:
+        """Discover master files again, adding new ones and removing those
+        no longer found, from their shards too. A file that still exists
+        but lost its headers then stops being synced, and one that comes
+        back is added again."""
+
+        found = {master_file.path: master_file for master_file in self.discover()}
+
+        for path in [path for masters in self.shard_masters for path in masters if path not in found]:
+            self.remove(path)
+
+        for master_file in found.values():
+            self.add(master_file)
+
+    def read_reports(self, timeout : float = None) -> None:
+
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            try:
+                kind, shard, value = self.reports.get(timeout= max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return
+
+            self.last_report[shard] = time.monotonic()
+            if kind == "metrics":
+                metrics.merge(value)
+            elif kind == "health":
+                self.latest[shard] = value
+            elif kind == "stopped":
+                self.stopped[shard] = value
+
+    def check_shards(self) -> None:
+        """Start shards whose process died again"""
+
+        for shard, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                self.restarts[shard] += 1
+                self.latest[shard] = None
+                self.start_shard(shard)
+
+    def health(self) -> dict:
+
+        now = time.monotonic()
+        return {
+            "time": time.time(),
+            "shards": [
+                {
+                    "shard": shard,
+                    "alive": process is not None and process.is_alive(),
+                    "restarts": self.restarts[shard],
+                    "assigned": len(self.shard_masters[shard]),
+                    "seconds_since_report": now - self.last_report[shard] if self.last_report[shard] is not None else None,
+                    "status": self.latest[shard]
+                }
+                for shard, process in enumerate(self.processes)
+            ]
+        }
+
+    def write_health(self) -> None:
+
+        if self.health_path is None:
+            return
+
+        temporary_path = self.health_path.with_name(self.health_path.name + ".tmp")
+        with open(temporary_path, "w") as f:
+            json.dump(self.health(), f, indent= 2)
+        os.replace(temporary_path, self.health_path)
+
+    def run_forever(self) -> None:
+        """Start the shards, then coordinate them until interrupted"""
+
+        self.start()
+        next_rescan = time.monotonic() + self.rescan_interval
+
+        while True:
+            self.read_reports(timeout= self.health_interval)
+            self.check_shards()
+            self.write_health()
+
+            if self.discover is not None and time.monotonic() >= next_rescan:
+                self.rescan()
+                next_rescan = time.monotonic() + self.rescan_interval
+
+    def stop(self, timeout : float = 10.) -> list[MasterFile]:
+        """Stop every shard, returning the master files they had, as
+        up to date as the shards that stopped cleanly left them"""
+
+        running = [shard for shard, process in enumerate(self.processes) if process is not None and process.is_alive()]
+        for shard in running:
+            self.commands[shard].put(("stop", None))
+
+        # Shards send their master files back before exiting
+        deadline = time.monotonic() + timeout
+        while any(shard not in self.stopped for shard in running) and time.monotonic() < deadline:
+            self.read_reports(timeout= min(.1, max(0, deadline - time.monotonic())))
+
+        for process in self.processes:
+            if process is None:
+                continue
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+        master_files : list[MasterFile] = []
+        for shard, masters in enumerate(self.shard_masters):
+            master_files.extend(self.stopped.get(shard, masters.values()))
+
+        return master_files
@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import os
+import pathlib
+
+from header import SectionHeader
+from file_class import HeaderScanner, MonitoredFile
+from instrumentation import metrics
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 1
+# section_description: Dialects
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+def comment_section_header(comment_prefix : str) -> SectionHeader:
+    """The standard section header, written as line comments starting with comment_prefix"""
+
+    rule = comment_prefix + " " + "~" * 70
+
+    return SectionHeader(
+        key_sequence= [
+            rule + "\n",
+            comment_prefix + " section number     : ",
+            "___number___",
+            "\n",
+            comment_prefix + " section description: ",
+            "___description___",
+            "\n",
+            rule
+        ],
+        key_number="___number___",
+        key_description="___description___"
+    )
+
+# Bytes read from the start of a file for its shebang line
+shebang_size = 256
+
+def read_shebang(path : pathlib.Path) -> str:
+    """Name of the interpreter a #! line runs, without its version,
+    so #!/usr/bin/env python3.11 gives python. None without one."""
+
+    try:
+        with open(path, "rb") as f:
+            line = f.readline(shebang_size)
+    except OSError:
+        return None
+
+    metrics.count("bytes_read", len(line))
+
+    if not line.startswith(b"#!"):
+        return None
+
+    words = line[2:].split()
+    if words and os.path.basename(words[0]) == b"env":
+        # env's own options come before the command
+        words = [word for word in words[1:] if not word.startswith(b"-") and b"=" not in word]
+    if not words:
+        return None
+
+    name = os.path.basename(words[0]).decode("utf-8", errors= "replace")
+    return name.rstrip("0123456789.") or name
+
+class Dialect:
+    """SectionHeaders used by one kind of file, and how to recognise the file
+
+    extensions are file types as MonitoredFile.filetype gives them, without
+    the dot, and shebangs are interpreter names as read_shebang gives them.
+    Each comment prefix adds the standard header written with it, after
+    any section_headers given.
+    """
+
+    __slots__ = ("name", "section_headers", "extensions", "shebangs", "comment_prefixes")
+
+    def __init__(
+            self,
+            name : str,
+            extensions : list[str] = (),
+            shebangs : list[str] = (),
+            comment_prefixes : list[str] = (),
+            section_headers : list[SectionHeader] = ()
+        ) -> None:
+
+        self.name = name
+        self.extensions = tuple(extension.lower().lstrip(".") for extension in extensions)
+        self.shebangs = tuple(shebangs)
+        self.comment_prefixes = tuple(comment_prefixes)
+        self.section_headers : list[SectionHeader] = list(section_headers)
+
+class DialectRegistry:
+    """Dialects by name, with the headers each file is scanned for.
+
+    A file is routed by its type to the dialects registered for it, then
+    by its shebang when its type is unknown. Only files routed nowhere are
+    scanned for every header, so the cost of scanning a file stays the
+    same as dialects are added. Dialects sharing a comment prefix share
+    one SectionHeader, and headers keep the order they were registered
+    in, which is also their priority when a file holds several.
+    """
+
+    def __init__(self) -> None:
+
+        self.dialects : dict[str, Dialect] = {}
+        self.headers : list[SectionHeader] = []
+
+        # Standard headers by comment prefix, so each is made once
+        self.comment_headers : dict[str, SectionHeader] = {}
+
+        self.extension_headers : dict[str, list[SectionHeader]] = {}
+        self.shebang_headers : dict[str, list[SectionHeader]] = {}
+
+        # Scanners for each set of headers a file was routed to, made on first use
+        self.scanners : dict[tuple[int, ...], HeaderScanner] = {}
+
+    def register(
+            self,
+            name : str,
+            extensions : list[str] = (),
+            shebangs : list[str] = (),
+            comment_prefixes : list[str] = (),
+            section_headers : list[SectionHeader] = ()
+        ) -> Dialect:
+        """Add a dialect, or replace the one registered under name"""
+
+        dialect = Dialect(name, extensions, shebangs, comment_prefixes, section_headers)
+
+        for comment_prefix in dialect.comment_prefixes:
+            header = self.comment_headers.get(comment_prefix)
+            if header is None:
+                header = self.comment_headers[comment_prefix] = comment_section_header(comment_prefix)
+            if header not in dialect.section_headers:
+                dialect.section_headers.append(header)
+
+        self.dialects[name] = dialect
+        self.rebuild()
+        return dialect
+
+    def unregister(self, name : str) -> None:
+
+        if self.dialects.pop(name, None) is not None:
+            self.rebuild()
+
+    def rebuild(self) -> None:
+
+        self.headers = []
+        self.extension_headers = {}
+        self.shebang_headers = {}
+        self.scanners = {}
+
+        for dialect in self.dialects.values():
+            for header in dialect.section_headers:
+                if header not in self.headers:
+                    self.headers.append(header)
+
+            for routes, keys in ((self.extension_headers, dialect.extensions), (self.shebang_headers, dialect.shebangs)):
+                for key in keys:
+                    routed = routes.setdefault(key, [])
+                    routed.extend(header for header in dialect.section_headers if header not in routed)
+
+        # Routed headers keep the registry's order
+        for routes in (self.extension_headers, self.shebang_headers):
+            for key, routed in routes.items():
+                routes[key] = [header for header in self.headers if header in routed]
+
+    def __getitem__(self, name : str) -> Dialect:
+        return self.dialects[name]
+
+    def __contains__(self, name : str) -> bool:
+        return name in self.dialects
+
+    def __iter__(self):
+        return iter(self.dialects.values())
+
+    def routed_headers(self, file : MonitoredFile) -> list[SectionHeader]:
+        """Headers of the dialects file is routed to, in priority order, or
+        None if it is routed nowhere. The file's type is looked up first,
+        and its shebang read only when that is unknown."""
+
+        if "." in file.path.name:
+            routed = self.extension_headers.get(file.filetype.lower())
+            if routed is not None:
+                return routed
+
+        if self.shebang_headers:
+            shebang = read_shebang(file.path)
+            if shebang is not None:
+                return self.shebang_headers.get(shebang)
+
+        return None
+
+    def headers_for(self, file : MonitoredFile, headers : list[SectionHeader] = None) -> list[SectionHeader]:
+        """Headers file may hold, out of headers, all of the registry's by
+        default. They keep the order of headers, which is their priority."""
+
+        if headers is None:
+            headers = self.headers
+
+        routed = self.routed_headers(file)
+        if routed is None:
+            return headers
+
+        return [header for header in headers if header in routed]
+
+    def scanner_for(self, file : MonitoredFile, headers : list[SectionHeader] = None) -> HeaderScanner:
+
+        headers = self.headers_for(file, headers)
+        key = tuple(id(header) for header in headers)
+
+        scanner = self.scanners.get(key)
+        if scanner is None:
+            scanner = self.scanners[key] = HeaderScanner(headers)
+
+        return scanner
+
+    def __getstate__(self) -> dict:
+        # Scanners are remade where they are used, rather than pickled to workers
+        state = self.__dict__.copy()
+        state["scanners"] = {}
+        return state
+
+def default_dialects() -> DialectRegistry:
+    """Registry of the dialects the command line knows"""
+
+    dialects = DialectRegistry()
+    dialects.register("python", extensions= ("py", "pyw", "pyi"), shebangs= ("python",), comment_prefixes= ("#",))
+    dialects.register("st", extensions= ("st",), comment_prefixes= ("//",))
+    dialects.register("shell", extensions= ("sh", "bash", "zsh"), shebangs= ("sh", "bash", "zsh"), comment_prefixes= ("#",))
+    dialects.register("c", extensions= ("c", "h", "cc", "cpp", "cxx", "hpp"), comment_prefixes= ("//",))
+    dialects.register("sql", extensions= ("sql",), comment_prefixes= ("--",))
+    dialects.register("yaml", extensions= ("yaml", "yml"), comment_prefixes= ("#",))
+
+    return dialects
@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+import os
+import re
+from pathlib import Path
+from collections.abc import Iterator
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 1
+# section_description: IgnoreRules
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+# Generated section files are never candidates
+sections_dir_name = "sections"
+
+default_excludes = (".git/", "__pycache__/")
+
+def pattern_regex(pattern : str) -> str:
+    """Regex source for the glob part of a gitignore style pattern.
+    A backslash makes the character after it literal."""
+
+    regex = []
+    index = 0
+
+    while index < len(pattern):
+        char = pattern[index]
+
+        if char == "\\":
+            regex.append(re.escape(pattern[index + 1 : index + 2] or char))
+            index += 2
+            continue
+
+        if pattern.startswith("**/", index):
+            regex.append("(?:.*/)?")
+            index += 3
+            continue
+
+        if pattern.startswith("**", index):
+            regex.append(".*")
+            index += 2
+            continue
+
+        if char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[":
+            end = bracket_end(pattern, index)
+            if end == -1:
+                regex.append(re.escape(char))
+            else:
+                regex.append(bracket_regex(pattern[index + 1 : end]))
+                index = end
+        else:
+            regex.append(re.escape(char))
+
+        index += 1
+
+    return "".join(regex)
+
+def bracket_end(pattern : str, start : int) -> int:
+    """Index of the ] closing the bracket expression opened at start,
+    passing over escaped characters, or -1"""
+
+    index = start + 1
+    while index < len(pattern):
+        if pattern[index] == "\\":
+            index += 2
+            continue
+        if pattern[index] == "]":
+            return index
+        index += 1
+
+    return -1
+
+def bracket_regex(body : str) -> str:
+    """Regex source for a bracket expression, its body being what is
+    between the brackets. Only ranges and a leading ! or ^ are special."""
+
+    regex = ["[^" if body[:1] in ("!", "^") else "["]
+    index = 1 if body[:1] in ("!", "^") else 0
+
+    while index < len(body):
+        char = body[index]
+        if char == "\\":
+            regex.append(re.escape(body[index + 1 : index + 2] or char))
+            index += 2
+            continue
+
+        regex.append(char if char == "-" else re.escape(char))
+        index += 1
+
+    regex.append("]")
+    return "".join(regex)
+
+def strip_pattern(pattern : str) -> str:
+    """pattern without surrounding whitespace, but for a trailing
+    space kept by a backslash before it"""
+
+    pattern = pattern.lstrip()
+    stripped = pattern.rstrip()
+
+    escapes = len(stripped) - len(stripped.rstrip("\\"))
+    if escapes % 2 and len(stripped) < len(pattern):
+        stripped += pattern[len(stripped)]
+
+    return stripped
+
+class IgnoreRules:
+    """gitignore style patterns, matched against paths relative to a walk root
+
+    A pattern with no slash, other than a trailing one, matches a name
+    at any depth, otherwise it matches from the root. A trailing slash
+    matches directories only, a leading ! re-includes what an earlier
+    pattern excluded and * does not cross slashes where ** does.
+    A backslash escapes the character after it, as in \\#name or \\!name.
+    The last pattern that matches wins.
+    """
+
+    def __init__(self, patterns : list[str] = ()) -> None:
+
+        self.rules : list[tuple[re.Pattern, bool, bool]] = []
+
+        for pattern in patterns:
+            pattern = strip_pattern(pattern)
+            if not pattern or pattern.startswith("#"):
+                continue
+
+            negate = pattern.startswith("!")
+            if negate:
+                pattern = pattern[1:]
+
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+
+            if "/" in pattern:
+                source = pattern_regex(pattern.lstrip("/"))
+            else:
+                source = "(?:.*/)?" + pattern_regex(pattern)
+
+            # The path itself, or anything inside a directory that matches
+            self.rules.append((re.compile(f"{source}(/.*)?"), negate, dir_only))
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+    def match(self, relative_path : str, is_dir : bool) -> bool:
+
+        matched = False
+        for regex, negate, dir_only in self.rules:
+            match = regex.fullmatch(relative_path)
+            if match is None:
+                continue
+
+            inside = match.group(1) is not None
+            if dir_only and not (is_dir or inside):
+                continue
+
+            matched = not negate
+
+        return matched
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 2
+# section_description: Walk
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+def walk_candidates(
+        root : str,
+        relative_dir : str,
+        include : IgnoreRules,
+        exclude : IgnoreRules,
+        recursive : bool
+    ) -> Iterator[Path]:
+
+    try:
+        entries = sorted(os.scandir(os.path.join(root, relative_dir)), key= lambda entry: entry.name)
+    except OSError:
+        return
+
+    # Files first, then subdirectories, each sorted by name
+    sub_dirs : list[str] = []
+
+    for entry in entries:
+        relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+
+        try:
+            # The file type comes from the directory listing, without a stat
+            is_dir = entry.is_dir(follow_symlinks= False)
+            is_file = not is_dir and entry.is_file()
+        except OSError:
+            continue
+
+        if exclude and exclude.match(relative_path, is_dir):
+            continue
+
+        if is_dir:
+            if recursive and entry.name != sections_dir_name:
+                sub_dirs.append(relative_path)
+
+        elif is_file:
+            if include and not include.match(relative_path, False):
+                continue
+            yield Path(entry.path)
+
+    for relative_path in sub_dirs:
+        yield from walk_candidates(root, relative_path, include, exclude, recursive)
+
+def iter_candidate_files(
+        paths : list[str],
+        include : list[str] = (),
+        exclude : list[str] = default_excludes,
+        recursive : bool = True
+    ) -> Iterator[Path]:
+    """Lazily yield every file under paths that could be a master file.
+
+    Directories are walked with os.scandir, reusing each entry's type
+    information, and generated sections directories are skipped.
+    Files given directly are always yielded. Nothing is yielded twice.
+    """
+
+    include_rules = IgnoreRules(include)
+    exclude_rules = IgnoreRules(exclude)
+    yielded : set[Path] = set()
+
+    for path in paths:
+        path = Path(path).resolve()
+
+        if path.is_dir():
+            candidates = walk_candidates(str(path), "", include_rules, exclude_rules, recursive)
+        elif path.is_file():
+            candidates = iter([path])
+        else:
+            continue
+
+        for candidate in candidates:
+            if candidate not in yielded:
+                yielded.add(candidate)
+                yield candidate
@@ -1,36 +1,164 @@
 from __future__ import annotations
 
+import array
+import bisect
+import codecs
+import hashlib
+import locale
+import mmap
 import pathlib
 import os
+import re
+import time
+from typing import TYPE_CHECKING
 
-from header import SectionHeader
-from icecream import ic
+from header import SectionHeader, CompiledSectionHeader
+from instrumentation import metrics
+
+if TYPE_CHECKING:
+    from dialects import DialectRegistry
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
 # section_number     : 6
 # section_description: file_classes
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
 
+def file_identity(path : pathlib.Path) -> tuple[int, int, int]:
+    """(size, st_mtime_ns, inode), which changes whenever the file content can have"""
+    metrics.count("stat_calls")
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+# Bytes read to decide whether a file is text
+probe_size = 8192
+
+def probe_readable(path : pathlib.Path) -> bool:
+    """True when the start of the file decodes as text in the encoding
+    open() would use. A NUL byte marks it as binary. Only probe_size
+    bytes are read, so large binaries are never pulled into memory."""
+
+    try:
+        with open(path, "rb") as f:
+            prefix = f.read(probe_size)
+    except OSError:
+        return False
+
+    metrics.count("bytes_read", len(prefix))
+
+    if b"\0" in prefix:
+        return False
+
+    # Incremental, so a character cut off at the end of the prefix is not an error
+    decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))()
+    try:
+        decoder.decode(prefix, final= False)
+    except UnicodeDecodeError:
+        return False
+
+    return True
+
+def file_digest(path : pathlib.Path) -> bytes:
+
+    digest = hashlib.blake2b(digest_size= 16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+            metrics.count("bytes_read", len(chunk))
+
+    return digest.digest()
+
+class StatChangeDetector:
+    """A file changed when its size or st_mtime_ns did.
+    File states are (size, st_mtime_ns, digest or None)."""
+
+    def state(self, path : pathlib.Path) -> tuple[int, int, bytes]:
+        metrics.count("stat_calls")
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        return stat.st_size, stat.st_mtime_ns, None
+
+    def check(self, path : pathlib.Path, previous : tuple[int, int, bytes]) -> tuple[bool, tuple[int, int, bytes]]:
+        """Whether the file changed since previous, and its state now"""
+
+        current = StatChangeDetector.state(self, path)
+        if current is None:
+            return False, previous
+
+        if previous is not None and current[:2] == previous[:2]:
+            return False, previous
+
+        return True, current
+
+class DigestChangeDetector(StatChangeDetector):
+    """Like StatChangeDetector, but when only the mtime moved the
+    content is digested, so touches and checkouts of identical bytes
+    are not changes. A size change needs no digest."""
+
+    def state(self, path : pathlib.Path) -> tuple[int, int, bytes]:
+
+        current = super().state(path)
+        if current is None:
+            return None
+
+        try:
+            return current[0], current[1], file_digest(path)
+        except OSError:
+            return current
+
+    def check(self, path : pathlib.Path, previous : tuple[int, int, bytes]) -> tuple[bool, tuple[int, int, bytes]]:
+
+        changed, current = super().check(path, previous)
+        if not changed or previous is None or current[0] != previous[0]:
+            return changed, current
+
+        current = self.state(path)
+        if current is None:
+            return False, previous
+
+        # Without a digest of the previous content it can not be ruled out
+        return previous[2] is None or current[2] != previous[2], current
+
+change_detectors = {
+    "stat": StatChangeDetector(),
+    "digest": DigestChangeDetector()
+}
+
 class MonitoredFile:
 
-    def __init__(self, path : pathlib.Path) -> None:
+    __slots__ = ("path", "filename", "filetype", "pulse_file_changed", "prev_state", "lines", "readable")
+
+    # Shared by every file, set from the command line
+    change_detector : StatChangeDetector = change_detectors["digest"]
+
+    def __init__(self, path : pathlib.Path, prev_state : tuple[int, int, bytes] = None) -> None:
         self.path = path
         self.filename = self.path.name.split(".")[0]
         self.filetype = self.path.name.split(".")[-1]
-        self.prev_mod_time = self.get_mod_time()
         self.pulse_file_changed : bool = False
 
-        # Attempt to read all lines on init to validate this is possible for this file.
-        try:
-            with open(self.path, "r") as f:
-                self.lines : list[str] = f.readlines()
-        except:
-            self.lines_readable = False
-        else:
-            self.lines_readable = True
+        # Only stat'ed here, unless the state is already known.
+        # A digest is taken when it is first needed.
+        if prev_state is None:
+            prev_state = change_detectors["stat"].state(path)
+        self.prev_state : tuple[int, int, bytes] = prev_state
+
+        self.lines : list[bytes] = []
 
-        # Save the RAM, we don't need the lines right now.
-        self.lines : list[str] = []
+        # Probed on first use, see probe_readable
+        self.readable : bool = None
+
+    @property
+    def lines_readable(self) -> bool:
+        if self.readable is None:
+            self.readable = probe_readable(self.path)
+        return self.readable
 
     def get_mod_time(self) -> float:
         try:
@@ -38,56 +166,190 @@ class MonitoredFile:
         except:
             return None
 
-    def detect_file_change(self) -> bool:
-        new_mod_time = self.get_mod_time()
-        if self.prev_mod_time != new_mod_time and new_mod_time is not None:
-            self.pulse_file_changed = True
-            self.prev_mod_time = new_mod_time
-        else:
-            self.pulse_file_changed = False
+    def reset_change_state(self, state : tuple[int, int, bytes] = None) -> None:
+        """Take state, or the file as it is now, as unchanged"""
+        self.prev_state = state if state is not None else self.change_detector.state(self.path)
 
+    def detect_file_change(self) -> bool:
+        self.pulse_file_changed, self.prev_state = self.change_detector.check(self.path, self.prev_state)
         return self.pulse_file_changed
 
     def __eq__(self, __value: object) -> bool:
         return self.path == __value.path
 
     def __hash__(self) -> int:
-        return hash(tuple(self.path, self.filename, self.filetype))
+        return hash((self.path, self.filename, self.filetype))
 
 class SectionFile(MonitoredFile):
     """MonitoredFile that is one numbered and described part of a MasterFile"""
 
+    __slots__ = ("section_number", "section_description", "master_file", "header_specifier")
+
     def __init__(
         self,
         path : pathlib.Path,
         section_number: int,
         section_description: str,
-        master_file : MasterFile
+        master_file : MasterFile,
+        prev_state : tuple[int, int, bytes] = None
     ) -> None:
 
-        super().__init__(path)
+        super().__init__(path, prev_state= prev_state)
         self.section_number = section_number
         self.section_description = section_description
-        self.lines : list[str] = []
+        self.lines : list[bytes] = []
         self.master_file = master_file
+        self.header_specifier : HeaderSpecifier = None
 
 class MasterFile(MonitoredFile):
     """MonitoredFile with sections delimited by headers"""
+
+    __slots__ = (
+        "dir_master_sections",
+        "sections",
+        "section_header",
+        "header_specifiers",
+        "header_identity",
+        "section_digests",
+        "sections_snapshot"
+    )
+
     def __init__(self, path : pathlib.Path) -> None:
 
         super().__init__(path)
         self.dir_master_sections = path.parent.resolve().joinpath("sections").joinpath(self.filename)
-        self.sections : list[SectionFile] = []
+        self.sections : SectionFiles = SectionFiles(self)
         self.section_header : SectionHeader = None
+        self.header_specifiers : SectionTable = SectionTable()
+
+        # file_identity of the file when header_specifiers were found
+        self.header_identity : tuple[int, int, int] = None
+
+        # Section file name to (size, st_mtime_ns, digest) for
+        # the section files this process last wrote
+        self.section_digests : dict[str, tuple[int, int, bytes]] = {}
+
+        # The sections directory as last looked at, None until then
+        # or after this process changes it, see SectionsSnapshot
+        self.sections_snapshot : SectionsSnapshot = None
+
+    def parse(self, use_mmap : bool = False) -> None:
+        """Split the file into sections using section_header. Lines are
+        bytes, each with its line ending as in the file. With use_mmap the
+        section lines are not read, section content is taken from open_map
+        instead."""
+
+        identity = self.scan_headers(use_mmap= use_mmap)
+
+        lines : list[bytes] = []
+        if not use_mmap:
+            # Read as bytes and split on b"\n" alone, so lines keep their
+            # endings, \r\n included, and nothing is ever decoded
+            with open(self.path, "rb") as f:
+                lines = f.readlines()
+            if identity is not None:
+                metrics.count("bytes_read", identity[0])
+
+        self.load_sections(lines)
+
+    def scan_headers(self, use_mmap : bool = False) -> tuple[int, int, int]:
+        """Find the headers again only if the file changed since they
+        were last found, returns the file's identity"""
+
+        identity = file_identity(self.path)
+        if identity is None or identity != self.header_identity:
+            with metrics.timer("parse"):
+                self.header_specifiers = parse_master_file_headers(self, use_mmap= use_mmap)
+            self.header_identity = identity
+
+        return identity
+
+    def find_sections(self, number : int = None, description : str = None) -> list[int]:
+        """Indexes of the sections with number and/or description, in file order.
+        Section lines are not read, headers are only scanned for if the file
+        changed, and the lookup itself is a bisect or a dict lookup."""
+
+        self.scan_headers(use_mmap= True)
+        table = self.header_specifiers
+
+        if number is None:
+            return table.rows_with_description(description) if description is not None else []
+
+        indexes = table.rows_in_number_range(number, number)
+        if description is not None:
+            indexes = [index for index in indexes if table.section_description[index] == description]
+
+        return indexes
+
+    def find_section_range(self, first : int, last : int) -> list[int]:
+        """Indexes of the sections numbered first through last, in file order"""
+
+        self.scan_headers(use_mmap= True)
+        return self.header_specifiers.rows_in_number_range(first, last)
+
+    def read_section(self, index : int) -> bytes:
+        """Code of one section, read from its byte range alone"""
+
+        table = self.header_specifiers
+        code_start_byte = table.value("code_start_byte", index)
+
+        with open(self.path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if (stat.st_size, stat.st_mtime_ns, stat.st_ino) != self.header_identity:
+                raise ValueError(f"{self.path} changed since its headers were found")
+
+            if code_start_byte is None:
+                return b""
+
+            f.seek(code_start_byte)
+            content = f.read(table.value("code_end_byte", index) - code_start_byte)
+
+        metrics.count("bytes_read", len(content))
+        return content
+
+    def get_section(self, number : int = None, description : str = None) -> bytes:
+        """Code of the first section with number and/or description, or None"""
+
+        indexes = self.find_sections(number= number, description= description)
+        if not indexes:
+            return None
+
+        return self.read_section(indexes[0])
+
+    def load_sections(self, lines : list[bytes] = None) -> None:
+        """Sections for header_specifiers, with their lines if given.
+        SectionFile objects are only made for the sections that are used."""
+
+        self.sections = SectionFiles(self, lines)
+
+    def open_map(self) -> MasterFileMap:
+        """Memory map the file, section content is then
+        available with section_view without being copied"""
+        return MasterFileMap(self.path)
 
 class HeaderSpecifier:
 
+    __slots__ = (
+        "header_start_line",
+        "header_end_line",
+        "code_start_line",
+        "code_end_line",
+        "section_number",
+        "section_description",
+        "header_start_byte",
+        "header_end_byte",
+        "code_start_byte",
+        "code_end_byte"
+    )
+
     def __init__(
             self,
             header_start_line,
             header_end_line,
             section_number,
-            section_description
+            section_description,
+            header_start_byte = None,
+            header_end_byte = None
         ) -> None:
 
         self.header_start_line = header_start_line
@@ -97,158 +359,907 @@ class HeaderSpecifier:
         self.section_number = section_number
         self.section_description = section_description
 
-def parse_master_file_headers(master_file : MasterFile) -> list[HeaderSpecifier]:
+        # Byte offsets into the master file. The header runs through
+        # the line break of its last line, the code from the start of
+        # its first line to the end of its last line, before the line break.
+        self.header_start_byte = header_start_byte
+        self.header_end_byte = header_end_byte
+        self.code_start_byte = None
+        self.code_end_byte = None
 
-    # The header sequence specifies the position
-    # in standard_header_sequence that is being
-    # parsed for
+    fields = __slots__
 
-    last_head_sq_index = len(master_file.section_header.key_sequence) - 1
+    def as_tuple(self) -> tuple:
+        return tuple(getattr(self, field) for field in self.fields)
 
-    head_sq_index = 0
-    parsing_header = False
-    header_lines : list[str] = []
-    return_header_specifiers : list[HeaderSpecifier] = []
-    new_header_specifier = None
+    @classmethod
+    def from_tuple(cls, values : tuple) -> HeaderSpecifier:
 
-    section_number = None
-    section_description = None
+        header_specifier = cls(None, None, None, None)
+        for field, value in zip(cls.fields, values):
+            setattr(header_specifier, field, value)
 
-    # ic("Parsing master file", master_file.filename)
+        return header_specifier
 
-    try:
-        with open(master_file.path, "r") as f:
-
-            for line_num, line in enumerate(f):
-                line : str
-
-                # ic("evaluating line\n", line)
-
-                index_char = 0
-
-                # Parse the entire line, which could contain
-                # several header sequence elements
-                while index_char < len(line):
-                    # ic(head_sq_index)
-                    current_header_sequence_string = master_file.section_header.key_sequence[head_sq_index]
-                    test_string = line[index_char : index_char + len(current_header_sequence_string)]
-                    header_sequence_match = test_string == current_header_sequence_string
-                    pulse_last_head_sq_index = last_head_sq_index == head_sq_index
-                    header_parse_success = False
-
-                    # ic(current_header_sequence_string, test_string, header_sequence_match, pulse_last_head_sq_index)
-
-                    # Header text match
-                    if header_sequence_match:
-                        index_char += len(master_file.section_header.key_sequence[head_sq_index])
-                        header_parse_success = True
-
-                    # Header sequence number
-                    if current_header_sequence_string == master_file.section_header.key_number:
-
-                        parse_key = False
-
-                        # Get the section number as string
-                        if pulse_last_head_sq_index:
-                            section_number_str = line[index_char:].strip()
-                            parse_key = True
-
-                        else:
-                            next_test_string = master_file.section_header.key_sequence[head_sq_index + 1]
-                            try:
-                                next_test_string_index = line[index_char:].index(next_test_string)
-                            except:
-                                pass
-                            else:
-                                section_number_str = line[index_char:][:next_test_string_index].strip()
-                                parse_key = True
-
-                        if parse_key:
-                            try:
-                                section_number = int(section_number_str)
-                            except:
-                                pass
-                            else:
-                                header_parse_success = True
-                                index_char += len(section_number_str)
-
-                    # Header sequence description
-                    if current_header_sequence_string == master_file.section_header.key_description:
-
-                        # Get the section number as string
-                        if pulse_last_head_sq_index:
-                            section_description = line[index_char:].strip()
-                            header_parse_success = True
-
-                        else:
-                            next_test_string = master_file.section_header.key_sequence[head_sq_index + 1]
-                            try:
-                                next_test_string_index = line[index_char:].index(next_test_string)
-                            except:
-                                pass
-                            else:
-                                section_description = line[index_char:][:next_test_string_index].strip()
-                                header_parse_success = True
-                                index_char += len(section_description)
-
-                    # Increment header sequence index
-                    # or reset if header parsing failure
-                    if header_parse_success:
-                        head_sq_index += 1
-                        if pulse_last_head_sq_index:
-
-                            head_sq_index = 0
-                            index_char = len(line)
-
-                            header_lines.append(line)
-
-                            # ic("header complete", line_num, header_lines)
-                            new_header_specifier = HeaderSpecifier(
-                                header_start_line= line_num - len(header_lines) + 1,
-                                header_end_line= line_num,
-                                section_description= section_description,
-                                section_number= section_number
-                            )
+class SectionTable:
+    """Header specifiers of one master file held column by column.
+
+    Every field but the description is an array of 64 bit integers, so a
+    master with many sections costs a few bytes per section rather than
+    an object each. Indexing or iterating hands out HeaderSpecifier
+    objects made on the spot. None is stored as none_value.
+    """
+
+    __slots__ = ("columns", "section_description", "number_index", "description_index")
+
+    none_value = -(1 << 63)
+    int_fields = tuple(field for field in HeaderSpecifier.fields if field != "section_description")
+
+    def __init__(self) -> None:
+        self.columns : dict[str, array.array] = {field: array.array("q") for field in self.int_fields}
+        self.section_description : list[str] = []
+
+        # Lookup indexes, built on first use
+        self.number_index : tuple[array.array, array.array] = None
+        self.description_index : dict[str, list[int]] = None
+
+    @classmethod
+    def from_specifiers(cls, header_specifiers : list[HeaderSpecifier]) -> SectionTable:
+
+        table = cls()
+        for header_specifier in header_specifiers:
+            table.append(*header_specifier.as_tuple())
+
+        return table
+
+    def append(
+            self,
+            header_start_line : int,
+            header_end_line : int,
+            code_start_line : int,
+            code_end_line : int,
+            section_number : int,
+            section_description : str,
+            header_start_byte : int,
+            header_end_byte : int,
+            code_start_byte : int,
+            code_end_byte : int
+        ) -> None:
+        """Add a row, arguments in HeaderSpecifier.fields order"""
+
+        none_value = self.none_value
+        columns = self.columns
+        for field, value in (
+            ("header_start_line", header_start_line),
+            ("header_end_line", header_end_line),
+            ("code_start_line", code_start_line),
+            ("code_end_line", code_end_line),
+            ("section_number", section_number),
+            ("header_start_byte", header_start_byte),
+            ("header_end_byte", header_end_byte),
+            ("code_start_byte", code_start_byte),
+            ("code_end_byte", code_end_byte)
+        ):
+            columns[field].append(none_value if value is None else value)
+
+        self.section_description.append(section_description)
+        self.number_index = None
+        self.description_index = None
+
+    def column(self, field : str) -> array.array:
+        return self.columns[field]
+
+    def value(self, field : str, index : int):
+        """One field of one row, None where nothing is stored"""
+
+        if field == "section_description":
+            return self.section_description[index]
+
+        value = self.columns[field][index]
+        return None if value == self.none_value else value
+
+    def sorted_numbers(self) -> tuple[array.array, array.array]:
+        """Section numbers in ascending order, and the row of each"""
+
+        if self.number_index is None:
+            numbers = self.columns["section_number"]
+            rows = sorted(range(len(numbers)), key= numbers.__getitem__)
+            self.number_index = (array.array("q", (numbers[row] for row in rows)), array.array("q", rows))
+
+        return self.number_index
+
+    def rows_in_number_range(self, first : int, last : int) -> list[int]:
+        """Rows numbered first through last, in row order"""
+
+        numbers, rows = self.sorted_numbers()
+        return sorted(rows[bisect.bisect_left(numbers, first) : bisect.bisect_right(numbers, last)])
+
+    def rows_with_description(self, description : str) -> list[int]:
+
+        if self.description_index is None:
+            self.description_index = {}
+            for row, row_description in enumerate(self.section_description):
+                self.description_index.setdefault(row_description, []).append(row)
+
+        return list(self.description_index.get(description, ()))
+
+    def __len__(self) -> int:
+        return len(self.section_description)
+
+    def __getitem__(self, index : int) -> HeaderSpecifier:
+
+        if index < 0:
+            index += len(self)
+
+        return HeaderSpecifier.from_tuple(tuple(self.value(field, index) for field in HeaderSpecifier.fields))
 
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __bool__(self) -> bool:
+        return bool(self.section_description)
+
+    def to_stored(self) -> tuple:
+        """Plain bytes and strings, for marshal"""
+        return tuple(self.columns[field].tobytes() for field in self.int_fields) + (list(self.section_description),)
+
+    @classmethod
+    def from_stored(cls, stored : tuple) -> SectionTable:
+
+        table = cls()
+        for field, column in zip(cls.int_fields, stored):
+            table.columns[field].frombytes(column)
+        table.section_description = list(stored[-1])
+
+        return table
+
+class SectionFiles:
+    """The sections of a master file, as SectionFile objects made
+    only when a section is first used and kept after that"""
+
+    __slots__ = ("master_file", "lines", "made")
+
+    def __init__(self, master_file : MasterFile, lines : list[bytes] = None) -> None:
+        self.master_file = master_file
+        self.lines = lines
+        self.made : dict[int, SectionFile] = {}
+
+    def name(self, index : int) -> str:
+        table = self.master_file.header_specifiers
+        return f"{table.value('section_number', index)}__{table.section_description[index]}.{self.master_file.filetype}"
+
+    def names(self) -> list[str]:
+
+        table = self.master_file.header_specifiers
+        filetype = self.master_file.filetype
+        return [
+            f"{number}__{description}.{filetype}"
+            for number, description in zip(table.column("section_number"), table.section_description)
+        ]
+
+    def section_lines(self, index : int) -> list[bytes]:
+
+        table = self.master_file.header_specifiers
+        code_start_line = table.value("code_start_line", index)
+        if not self.lines or code_start_line is None:
+            return []
+
+        return self.lines[code_start_line : table.value("code_end_line", index) + 1]
+
+    def __len__(self) -> int:
+        return len(self.master_file.header_specifiers)
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __getitem__(self, index : int) -> SectionFile:
+
+        if index < 0:
+            index += len(self)
+
+        section = self.made.get(index)
+        if section is not None:
+            return section
+
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        master_file = self.master_file
+        header_specifier = master_file.header_specifiers[index]
+        name = self.name(index)
+
+        # A digest recorded when the section was written is its state
+        # until it changes, so a section made from it needs no stat
+        recorded = master_file.section_digests.get(name)
+
+        section = SectionFile(
+            path= master_file.dir_master_sections.joinpath(name),
+            section_number= header_specifier.section_number,
+            section_description= header_specifier.section_description,
+            master_file= master_file,
+            prev_state= tuple(recorded) if recorded is not None else None
+        )
+        section.header_specifier = header_specifier
+        section.lines = self.section_lines(index)
+
+        self.made[index] = section
+        return section
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def made_section(self, index : int) -> SectionFile:
+        """The SectionFile for index if one was made, without making it"""
+        return self.made.get(index)
+
+# number__description.filetype, as SectionFiles.name gives them
+section_file_name_pattern = re.compile(r"-?(?:0|[1-9][0-9]*)__.*\.([^.]*)", re.DOTALL)
+
+def is_section_file_name(name : str, filetype : str) -> bool:
+    """True for names SectionFiles.name could give a section of a master
+    file of filetype, so not for backups like 1__a.py~ or 1__a.py.orig"""
+
+    match = section_file_name_pattern.fullmatch(name)
+    return match is not None and match.group(1) == filetype
+
+class SectionsSnapshot:
+    """(size, st_mtime_ns) of each section file in a sections directory,
+    and the directory's own st_mtime_ns when it was listed.
+
+    Adding, removing or renaming an entry moves the directory's mtime,
+    so while it stays put the directory is not listed again and only
+    the entries already known are stat'ed. A directory mtime too close
+    to the time it was read could still move within the same timestamp
+    tick, so it is not trusted and the next look lists the directory.
+    """
+
+    __slots__ = ("dir_mtime_ns", "entries")
+
+    # Directory mtimes this recent when read are not trusted
+    racy_window_ns = 2_000_000_000
+
+    def __init__(self, entries : dict[str, tuple[int, int]] = None, dir_mtime_ns : int = None) -> None:
+        self.dir_mtime_ns = dir_mtime_ns
+        self.entries : dict[str, tuple[int, int]] = entries if entries is not None else {}
+
+    @classmethod
+    def from_digests(cls, section_digests : dict[str, tuple[int, int, bytes]]) -> SectionsSnapshot:
+        """The section files as they were written, with the directory still to be listed"""
+        return cls({name: tuple(recorded[:2]) for name, recorded in section_digests.items()})
+
+    def refresh(self, dir : pathlib.Path, filetype : str) -> tuple[bool, list[str]]:
+        """Look at dir again, for section files of a master of filetype.
+        Returns whether it had to be listed, and the names of the entries
+        that appeared, disappeared or changed since. Other files are left
+        out. Raises OSError if dir can not be read."""
+
+        metrics.count("stat_calls")
+        dir_mtime_ns = os.stat(dir).st_mtime_ns
+
+        current : dict[str, tuple[int, int]] = None
+        listed = dir_mtime_ns != self.dir_mtime_ns
+
+        if not listed:
+            current = {}
+            for name in self.entries:
+                metrics.count("stat_calls")
+                try:
+                    stat = os.stat(dir.joinpath(name))
+                except OSError:
+                    # Gone within the same mtime tick
+                    listed = True
+                    break
+                current[name] = (stat.st_size, stat.st_mtime_ns)
+
+        if listed:
+            metrics.count("dirs_listed")
+            current = {}
+            with os.scandir(dir) as entries:
+                for entry in entries:
+                    if not is_section_file_name(entry.name, filetype):
+                        continue
+                    try:
+                        if not entry.is_file():
+                            continue
+                        metrics.count("stat_calls")
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    current[entry.name] = (stat.st_size, stat.st_mtime_ns)
+
+        previous = self.entries
+        changed = [name for name, state in current.items() if previous.get(name) != state]
+        changed.extend(name for name in previous if name not in current)
+
+        self.entries = current
+        racy = time.time_ns() - dir_mtime_ns < self.racy_window_ns
+        self.dir_mtime_ns = None if racy else dir_mtime_ns
+
+        return listed, changed
+
+def line_content_end(line : bytes) -> int:
+    """Length of a line without its line break"""
+
+    if line.endswith(b"\r\n"):
+        return len(line) - 2
+    if line.endswith(b"\n"):
+        return len(line) - 1
+    return len(line)
+
+class HeaderParser:
+    """Line fed state machine that finds the headers of one SectionHeader"""
+
+    def __init__(self, section_header : SectionHeader) -> None:
+
+        # The header line index specifies which line
+        # of the compiled header is being parsed for
+
+        self.section_header = section_header
+        self.compiled_header = section_header.compile()
+
+        self.header_line_index = 0
+        self.header_start_byte = None
+        self.header_specifiers : list[HeaderSpecifier] = []
+        self.new_header_specifier : HeaderSpecifier = None
+
+        self.section_number = None
+        self.section_description = None
+
+    @property
+    def idle(self) -> bool:
+        """True when no header is partially matched"""
+        return self.header_line_index == 0
+
+    def feed_code_line(self, line_num : int, line_start : int, line : bytes) -> None:
+        """Record a line that does not start or continue a header"""
+
+        self.header_line_index = 0
+
+        if self.new_header_specifier is not None and line.strip():
+
+            if self.new_header_specifier.code_start_line is None:
+                self.new_header_specifier.code_start_line = line_num
+                self.new_header_specifier.code_start_byte = line_start
+
+            self.new_header_specifier.code_end_line = line_num
+            self.new_header_specifier.code_end_byte = line_start + line_content_end(line)
+
+    def feed_code_lines(self, line_num : int, line_start : int, data, start : int, end : int) -> None:
+        """Record data[start:end], whole lines from line_num on of which
+        none starts or continues a header, as feed_code_line would one by one"""
+
+        self.header_line_index = 0
+
+        header_specifier = self.new_header_specifier
+        if header_specifier is None:
+            return
+
+        first = HeaderScanner.non_blank.search(data, start, end)
+        if first is None:
+            return
+
+        if header_specifier.code_start_line is None:
+            first_line_start = data.rfind(b"\n", start, first.start()) + 1 or start
+            header_specifier.code_start_line = line_num + count_newlines(data, start, first_line_start)
+            header_specifier.code_start_byte = line_start + first_line_start - start
+
+        last = last_non_blank(data, start, end)
+        last_line_start = data.rfind(b"\n", start, last) + 1 or start
+
+        # Only a line break is left off, like line_content_end does
+        last_line_end = data.find(b"\n", last, end)
+        if last_line_end == -1:
+            last_line_end = end
+        elif data[last_line_end - 1 : last_line_end] == b"\r":
+            last_line_end -= 1
+
+        header_specifier.code_end_line = line_num + count_newlines(data, start, last_line_start)
+        header_specifier.code_end_byte = line_start + last_line_end - start
+
+    def feed(self, line_num : int, line_start : int, line : bytes) -> None:
+
+        values = self.compiled_header.match_line(self.header_line_index, line)
+
+        # Reset if header parsing failure
+        if values is None:
+            self.feed_code_line(line_num, line_start, line)
+            return
+
+        if self.section_header.key_number in values:
+            self.section_number = values[self.section_header.key_number]
+
+        if self.section_header.key_description in values:
+            self.section_description = values[self.section_header.key_description]
+
+        if self.header_line_index == 0:
+            self.header_start_byte = line_start
+
+        self.header_line_index += 1
+        if self.header_line_index < self.compiled_header.line_count:
+            return
+
+        # Header complete
+        self.header_line_index = 0
+
+        # The previous section ends where this header starts
+        if self.new_header_specifier is not None:
+            self.header_specifiers.append(self.new_header_specifier)
+
+        self.new_header_specifier = HeaderSpecifier(
+            header_start_line= line_num - self.compiled_header.line_count + 1,
+            header_end_line= line_num,
+            section_description= self.section_description,
+            section_number= self.section_number,
+            header_start_byte= self.header_start_byte,
+            header_end_byte= line_start + len(line)
+        )
+
+    def finish(self) -> list[HeaderSpecifier]:
+
+        if self.new_header_specifier is not None:
+            self.header_specifiers.append(self.new_header_specifier)
+            self.new_header_specifier = None
+
+        return self.header_specifiers
+
+# Bytes copied at a time when searching a memory map,
+# which has no count or rstrip of its own
+scan_chunk_size = 1 << 20
+
+def count_newlines(data, start : int, end : int) -> int:
+
+    if isinstance(data, bytes):
+        return data.count(b"\n", start, end)
+
+    count = 0
+    for chunk_start in range(start, end, scan_chunk_size):
+        count += data[chunk_start : min(end, chunk_start + scan_chunk_size)].count(b"\n")
+
+    return count
+
+def last_non_blank(data, start : int, end : int) -> int:
+    """Position of the last non whitespace byte in data[start:end], or None"""
+
+    while end > start:
+        chunk_start = max(start, end - scan_chunk_size)
+        stripped = data[chunk_start:end].rstrip()
+        if stripped:
+            return chunk_start + len(stripped) - 1
+        end = chunk_start
+
+    return None
+
+class LineCounter:
+    """Line number of a position in data, counted from the last position asked for"""
+
+    def __init__(self, data) -> None:
+        self.data = data
+        self.pos = 0
+        self.line_num = 0
+
+    def line_of(self, pos : int) -> int:
+
+        if pos >= self.pos:
+            self.line_num += count_newlines(self.data, self.pos, pos)
+        else:
+            self.line_num -= count_newlines(self.data, pos, self.pos)
+
+        self.pos = pos
+        return self.line_num
+
+# Files up to this size are read for the prefilter, larger ones mapped
+prefilter_read_size = 1 << 16
+
+class HeaderScanner:
+    """Finds the headers of several SectionHeader dialects in one read of a file"""
+
+    non_blank = re.compile(rb"\S")
+
+    def __init__(self, section_headers : list[SectionHeader]) -> None:
+
+        self.section_headers = list(section_headers)
+        self.compiled_headers = [header.compile() for header in self.section_headers]
+
+        # A line that starts with none of the header start literals
+        # can only be code for a dialect that is not mid header.
+        # Headers starting with a placeholder disable the shortcut.
+        start_literals = [compiled.start_literal for compiled in self.compiled_headers]
+        self.header_starts = tuple(start_literals) if all(start_literals) else None
+
+        # One pattern finds the candidate header lines of every dialect.
+        # It is not anchored with ^ so the regex engine can search
+        # for the literals, the line start is checked per match.
+        self.start_pattern = None
+        self.start_dialects : dict[str, list[int]] = {}
+
+        if self.header_starts is not None:
+            alternatives = sorted(set(start_literals), key= len, reverse= True)
+            self.start_pattern = re.compile(
+                b"|".join(b"(?P<start%d>%s)" % (index, re.escape(s)) for index, s in enumerate(alternatives))
+            )
+
+            # A line starting with one literal also starts with any literal that prefixes it
+            for index, s in enumerate(alternatives):
+                self.start_dialects[f"start{index}"] = [
+                    dialect for dialect, literal in enumerate(start_literals) if s.startswith(literal)
+                ]
+
+        self.anchors = [compiled.anchor for compiled in self.compiled_headers]
+
+    def might_match(self, data) -> bool:
+        """False when data can hold no header of any dialect, found with
+        a plain substring search for each dialect's anchor literal"""
+
+        for anchor in self.anchors:
+            if anchor is not None and data.find(anchor) != -1:
+                return True
+
+        return False
+
+    def scan_lines(self, lines) -> dict[SectionHeader, SectionTable]:
+        """Line at a time scan of bytes lines, for sources that are not held in memory"""
+
+        parsers = [HeaderParser(header) for header in self.section_headers]
+        line_start = 0
+
+        for line_num, line in enumerate(lines):
+            line : bytes
+
+            if self.header_starts is not None and not line.startswith(self.header_starts):
+                for parser in parsers:
+                    if parser.idle:
+                        parser.feed_code_line(line_num, line_start, line)
                     else:
-                        # ic("just a regular line", line)
-                        head_sq_index = 0
-                        index_char = len(line)
+                        parser.feed(line_num, line_start, line)
+
+            else:
+                for parser in parsers:
+                    parser.feed(line_num, line_start, line)
 
-                        if new_header_specifier is not None:
-                            # ic("parsing when code starts and ends...")
+            line_start += len(line)
 
-                            if line.strip() and new_header_specifier.code_start_line is None:
-                                new_header_specifier.code_start_line = line_num
-                                # ic(new_header_specifier.code_start_line)
+        found : dict[SectionHeader, SectionTable] = {}
+        for parser in parsers:
+            header_specifiers = parser.finish()
+            if header_specifiers:
+                found[parser.section_header] = SectionTable.from_specifiers(header_specifiers)
 
-                            if line.strip():
-                                new_header_specifier.code_end_line = line_num
-                                # ic(new_header_specifier.code_end_line)
+        return found
 
-                if not parsing_header:
-                    header_lines = []
+    def scan_data(self, data) -> dict[SectionHeader, SectionTable]:
+        """Scan the whole file held as bytes or a memory map"""
 
-                if header_parse_success and not pulse_last_head_sq_index:
-                    parsing_header = True
-                    header_lines.append(line.strip())
-                    # ic("Header parse success",header_lines)
+        candidates : list[list[int]] = [[] for _ in self.compiled_headers]
 
-                elif parsing_header:
+        if self.start_pattern is None:
+            line_starts = [0] + [match.end() for match in re.finditer(b"\n", data)]
+            for header_candidates in candidates:
+                header_candidates.extend(line_starts)
 
-                    parsing_header = False
-                    header_lines = []
+        else:
+            for match in self.start_pattern.finditer(data):
+                pos = match.start()
+                if pos and data[pos - 1 : pos] != b"\n":
+                    continue
+                for dialect in self.start_dialects[match.lastgroup]:
+                    candidates[dialect].append(pos)
+
+        found : dict[SectionHeader, SectionTable] = {}
+        for compiled, header_candidates in zip(self.compiled_headers, candidates):
+            if header_candidates:
+                header_specifiers = self.scan_dialect(compiled, data, header_candidates)
+                if header_specifiers:
+                    found[compiled.section_header] = header_specifiers
+
+        return found
+
+    def scan_dialect(
+            self,
+            compiled : CompiledSectionHeader,
+            data,
+            candidates : list[int]
+        ) -> SectionTable:
+        """Same results as feeding every line to a HeaderParser,
+        with Python level work only at candidate header lines"""
+
+        key_number = compiled.section_header.key_number
+        key_description = compiled.section_header.key_description
+        data_end = len(data)
+
+        # Header spans and the spans of headers that never completed,
+        # neither of which count as code lines
+        header_spans : list[tuple[int, int, int]] = []
+        header_values : list[tuple[int, str]] = []
+        skipped_spans : list[tuple[int, int]] = []
+
+        section_number = None
+        section_description = None
+        resume = 0
+
+        for start in candidates:
+            if start < resume:
+                continue
+
+            header_match = compiled.match_header(data, start)
+
+            # The last header line has to exist, even if it matches empty
+            if header_match is not None and header_match[1] < data_end:
+                values, last_line_start, pos = header_match
+                section_number = values.get(key_number, section_number)
+                section_description = values.get(key_description, section_description)
+
+                # The header takes the whole of its last line
+                if pos == last_line_start or data[pos - 1 : pos] != b"\n":
+                    line_end = data.find(b"\n", pos)
+                    pos = data_end if line_end == -1 else line_end + 1
+
+                header_spans.append((start, pos, last_line_start))
+                header_values.append((section_number, section_description))
+                resume = pos
+                continue
+
+            # Find how far a header that does not match got, line by line
+            pos = start
+            header_line_index = 0
+
+            while pos < data_end and header_line_index < compiled.line_count:
+                line_end = data.find(b"\n", pos)
+                line_end = data_end if line_end == -1 else line_end + 1
+
+                values = compiled.match_line(header_line_index, data[pos:line_end])
+
+                # A failed line is code and does not start a new header
+                if values is None:
+                    resume = line_end
+                    break
+
+                section_number = values.get(key_number, section_number)
+                section_description = values.get(key_description, section_description)
+
+                header_line_index += 1
+                pos = line_end
+
+            if header_line_index:
+                skipped_spans.append((start, pos))
+                resume = max(resume, pos)
+
+        counter = LineCounter(data)
+        skipped_starts = [span[0] for span in skipped_spans]
+        header_specifiers = SectionTable()
+
+        for index, (start, end, last_line_start) in enumerate(header_spans):
+
+            # The line counter only moves forward
+            header_start_line = counter.line_of(start)
+            header_end_line = counter.line_of(last_line_start)
+
+            code_region_end = header_spans[index + 1][0] if index + 1 < len(header_spans) else data_end
+            code_start, code_end = self.find_code(data, end, code_region_end, skipped_spans, skipped_starts)
+
+            code_start_line = code_end_line = code_start_byte = code_end_byte = None
+
+            if code_start is not None:
+                code_start_line = counter.line_of(code_start)
+                code_end_line = counter.line_of(code_end)
+
+                code_start_byte = data.rfind(b"\n", end, code_start) + 1 or end
+
+                line_end = data.find(b"\n", code_end)
+                line_end = data_end if line_end == -1 else line_end
+                if data[line_end - 1 : line_end] == b"\r":
+                    line_end -= 1
+                code_end_byte = line_end
+
+            header_specifiers.append(
+                header_start_line= header_start_line,
+                header_end_line= header_end_line,
+                code_start_line= code_start_line,
+                code_end_line= code_end_line,
+                section_number= header_values[index][0],
+                section_description= header_values[index][1],
+                header_start_byte= start,
+                header_end_byte= end,
+                code_start_byte= code_start_byte,
+                code_end_byte= code_end_byte
+            )
+
+        return header_specifiers
 
-            if new_header_specifier is not None:
-                return_header_specifiers.append(new_header_specifier)
+    def find_code(
+            self,
+            data,
+            start : int,
+            end : int,
+            skipped_spans : list[tuple[int, int]],
+            skipped_starts : list[int]
+        ) -> tuple[int, int]:
+        """Positions of the first and last non blank bytes outside skipped spans"""
+
+        def skipped_span_at(pos : int) -> tuple[int, int]:
+            index = bisect.bisect_right(skipped_starts, pos) - 1
+            if index >= 0 and skipped_spans[index][0] <= pos < skipped_spans[index][1]:
+                return skipped_spans[index]
+            return None
+
+        code_start = None
+        pos = start
+        while pos < end:
+            match = self.non_blank.search(data, pos, end)
+            if match is None:
+                break
+            span = skipped_span_at(match.start())
+            if span is None:
+                code_start = match.start()
+                break
+            pos = span[1]
+
+        if code_start is None:
+            return None, None
+
+        code_end = None
+        while end > code_start:
+            last = last_non_blank(data, start, end)
+            span = skipped_span_at(last)
+            if span is None:
+                code_end = last
+                break
+            end = span[0]
+
+        return code_start, code_end
+
+    def scan(self, path : pathlib.Path, use_mmap : bool = False) -> dict[SectionHeader, SectionTable]:
+        """Map each dialect used by the file to its headers, in dialect order"""
+
+        metrics.count("files_scanned")
+
+        try:
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
 
-    except PermissionError:
-        pass
+                # Small files are cheaper to read than to map
+                if size <= prefilter_read_size and not use_mmap:
+                    data = f.read()
+                    metrics.count("bytes_read", len(data))
+                    if not self.might_match(data):
+                        metrics.count("files_rejected")
+                        return {}
+                    return self.scan_data(data)
 
-    return return_header_specifiers
+                # Files without headers are rejected from the map, without reading them in
+                with MasterFileMap(path) as mapped:
+                    metrics.count("bytes_mapped", len(mapped.data))
+                    if not self.might_match(mapped.data):
+                        metrics.count("files_rejected")
+                        return {}
+
+                    if use_mmap:
+                        return self.scan_data(mapped.data)
+
+                data = f.read()
+
+        except PermissionError:
+            return {}
+
+        metrics.count("bytes_read", len(data))
+        return self.scan_data(data)
+
+class MasterFileMap:
+    """Read only memory map of a master file that hands out
+    sections as memoryview slices instead of copies"""
+
+    def __init__(self, path : pathlib.Path) -> None:
+
+        self.path = path
+        self.file = open(path, "rb")
+
+        # Empty files cannot be mapped
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access= mmap.ACCESS_READ)
+        except ValueError:
+            self.data = b""
+
+    def view(self, start : int, end : int) -> memoryview:
+        """Zero copy slice, release it before closing the map"""
+        return memoryview(self.data)[start:end]
+
+    def section_view(self, header_specifier : HeaderSpecifier) -> memoryview:
+
+        if header_specifier.code_start_byte is None:
+            return memoryview(b"")
+
+        return self.view(header_specifier.code_start_byte, header_specifier.code_end_byte)
+
+    def close(self) -> None:
+
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+        self.file.close()
+
+    def __enter__(self) -> MasterFileMap:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def discover_master_file(
+        path : pathlib.Path,
+        scanner : HeaderScanner,
+        dialects : DialectRegistry = None
+    ) -> tuple[tuple[int, int, int], MasterFile, int]:
+    """Check one candidate file for headers. Returns its file_identity,
+    and the MasterFile and index of its header in the scanner if it has any.
+    With dialects, only the scanner's headers the file is routed to are
+    scanned for."""
+
+    # Taken before scanning, a change during the scan is seen next time
+    identity = file_identity(path)
+
+    master_file = MasterFile(path)
+    if not master_file.lines_readable:
+        return identity, None, None
+
+    # The index is into the headers the caller gave, not the routed ones
+    headers = scanner.section_headers
+    if dialects is not None:
+        scanner = dialects.scanner_for(master_file, headers)
+        if not scanner.section_headers:
+            return identity, None, None
+
+    found_headers = scanner.scan(path)
+
+    # Headers earlier in the list take priority
+    for header in scanner.section_headers:
+        if header in found_headers:
+            master_file.section_header = header
+            master_file.header_specifiers = found_headers[header]
+            master_file.header_identity = identity
+            return identity, master_file, headers.index(header)
+
+    return identity, None, None
+
+# Set once per worker process, so headers are not sent with every file
+worker_scanner : HeaderScanner = None
+worker_dialects : DialectRegistry = None
+
+def init_discovery_worker(
+        section_headers : list[SectionHeader],
+        dialects : DialectRegistry = None,
+        metrics_enabled : bool = False
+    ) -> None:
+    global worker_scanner, worker_dialects
+
+    # Both arrive in one pickle, or by fork, so the worker's copies of
+    # section_headers are still the headers its copy of the registry holds
+    worker_scanner = HeaderScanner(section_headers)
+    worker_dialects = dialects
+
+    # A forked worker starts with a copy of the parent's totals
+    metrics.reset()
+    if metrics_enabled:
+        metrics.enable()
+    else:
+        metrics.disable()
+
+def discover_in_worker(path : pathlib.Path) -> tuple[tuple[int, int, int], MasterFile, int, dict]:
+    """discover_master_file in a worker, with the metrics it took for the parent to merge"""
+
+    return (
+        *discover_master_file(path, worker_scanner, worker_dialects),
+        metrics.take() if metrics.enabled else None
+    )
+
+def parse_master_file_headers(master_file : MasterFile, use_mmap : bool = False) -> SectionTable:
+
+    scanner = HeaderScanner([master_file.section_header])
+    return scanner.scan(master_file.path, use_mmap= use_mmap).get(master_file.section_header, SectionTable())
 
 if __name__ == "__main__":
 
+    from header import header_encoding
+
     section_header = SectionHeader(
         key_sequence= [
             "numnumnum",
@@ -304,11 +1315,8 @@ if __name__ == "__main__":
     for section in mfile.sections:
         print(f"Section {section.section_number}, {section.section_description}")
         for line in section.lines:
-            print(f"\t{line}")
-
-        with open(section.path, "w") as f:
-            for line_number, line in enumerate(section.lines):
-                if line_number < len(section.lines) - 1:
-                    f.write(line + "\n")
-                else:
-                    f.write(line)
\ No newline at end of file
+            print(f"\t{line.decode(header_encoding, errors= 'replace').rstrip()}")
+
+        # Lines keep their endings, only the one after the last line is left off
+        with open(section.path, "wb") as f:
+            f.write(re.sub(rb"\r?\n\Z", b"", b"".join(section.lines)))
\ No newline at end of file
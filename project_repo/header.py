@@ -1,4 +1,7 @@
-from enum import Enum, auto as enum_auto
+from __future__ import annotations
+
+import hashlib
+import re
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
 # section_number     : 1
@@ -17,21 +20,277 @@ class SectionHeader:
         self.key_sequence = key_sequence
         self.key_number = key_number
         self.key_description = key_description
+        self.compiled_header : CompiledSectionHeader = None
+        self.header_template : HeaderTemplate = None
+
+    def fingerprint(self) -> str:
+        """Stable across runs, for recognising the same header in stored data"""
+
+        digest = hashlib.blake2b(digest_size= 8)
+        for element in (self.key_number, self.key_description, *self.key_sequence):
+            digest.update(element.encode(header_encoding) + b"\0")
+
+        return digest.hexdigest()
+
+    def compile(self) -> CompiledSectionHeader:
+        """Build the compiled matcher once and reuse it afterwards"""
+
+        if self.compiled_header is None:
+            self.compiled_header = CompiledSectionHeader(self)
+
+        return self.compiled_header
+
+    def template(self) -> HeaderTemplate:
+        """Build the rendering template once and reuse it afterwards"""
+
+        if self.header_template is None:
+            self.header_template = HeaderTemplate(self)
+
+        return self.header_template
 
     def generate_empty_header(self) -> str:
         return ''.join(s for s in self.key_sequence)
 
     def generate_header(self, number : int, description : str) -> str:
+        return self.template().render(number, description)
+
+class HeaderTemplate:
+    """The empty header split once into literal text and placeholder
+    slots, so a header is rendered with a single join"""
+
+    def __init__(self, section_header : SectionHeader) -> None:
+
+        keys = sorted((section_header.key_number, section_header.key_description), key= len, reverse= True)
+        key_pattern = re.compile("(" + "|".join(re.escape(key) for key in keys) + ")")
+
+        self.parts : list[str] = []
+        self.number_slots : list[int] = []
+        self.description_slots : list[int] = []
+
+        for part in key_pattern.split(section_header.generate_empty_header()):
+            if part == section_header.key_number:
+                self.number_slots.append(len(self.parts))
+            elif part == section_header.key_description:
+                self.description_slots.append(len(self.parts))
+            self.parts.append(part)
+
+    def render(self, number : int, description : str) -> str:
+
+        parts = self.parts.copy()
+        for slot in self.number_slots:
+            parts[slot] = str(number)
+        for slot in self.description_slots:
+            parts[slot] = description
+
+        return "".join(parts)
+
+header_encoding = "utf-8"
+
+def literal_pattern(element : str) -> bytes:
+    """Regex source for a literal key_sequence element, matched against raw file bytes.
+    A trailing newline also matches CRLF, as reading in text mode used to."""
+
+    encoded = element.encode(header_encoding)
+    if encoded.endswith(b"\n"):
+        return re.escape(encoded[:-1]) + rb"\r?\n"
+
+    return re.escape(encoded)
+
+class CompiledSectionHeader:
+    """SectionHeader key_sequence compiled into one regex per header line
+
+    A header line is every key_sequence element up to and including
+    the next element that ends in a newline. Each line pattern is
+    matched against the raw bytes at the start of a line of the file,
+    so a header is found without stepping through the line a character
+    at a time and byte offsets into the file stay exact.
+    """
+
+    def __init__(self, section_header : SectionHeader) -> None:
+
+        self.section_header = section_header
+        self.line_patterns : list[re.Pattern] = []
+        line_sources : list[bytes] = []
+
+        # Placeholder keys captured by each line pattern, in group order,
+        # paired with whether the placeholder takes the rest of the line
+        self.line_keys : list[list[tuple[str, bool]]] = []
+
+        placeholders = (section_header.key_number, section_header.key_description)
+        key_sequence = section_header.key_sequence
+        last_index = len(key_sequence) - 1
+
+        line_pattern : list[bytes] = []
+        line_keys : list[tuple[str, bool]] = []
+
+        for index, element in enumerate(key_sequence):
+
+            if element in placeholders:
+                line_keys.append((element, index == last_index))
+
+                if index == last_index:
+                    # The last placeholder takes the rest of the line
+                    line_pattern.append(b"(.*)")
+                else:
+                    # Everything up to the first occurrence of the next element
+                    next_element = literal_pattern(key_sequence[index + 1])
+                    line_pattern.append(b"((?:(?!" + next_element + b").)*)")
 
-        new_header = self.generate_empty_header()
+                continue
 
-        while self.key_number in new_header:
-            new_header = new_header.replace(self.key_number, str(number))
+            if "\n" in element[:-1]:
+                # Lines are matched one at a time, so an element
+                # spanning a line break can never match
+                line_pattern.append(b"(?!)")
+            else:
+                line_pattern.append(literal_pattern(element))
 
-        while self.key_description in new_header:
-            new_header = new_header.replace(self.key_description, description)
+            if element.endswith("\n") or index == last_index:
+                line_sources.append(b"".join(line_pattern))
+                self.line_keys.append(line_keys)
+                line_pattern = []
+                line_keys = []
 
-        return new_header
+        if line_pattern:
+            line_sources.append(b"".join(line_pattern))
+            self.line_keys.append(line_keys)
+
+        self.line_patterns = [re.compile(source) for source in line_sources]
+        self.line_count = len(self.line_patterns)
+
+        # Every line at once, for the common case of a header that matches.
+        # The empty group marks where the last header line starts.
+        self.header_pattern = re.compile(b"".join(line_sources[:-1]) + b"(?P<last_line>)" + line_sources[-1])
+        self.header_keys = [key for line_keys in self.line_keys for key in line_keys]
+        self.last_line_group = sum(len(line_keys) for line_keys in self.line_keys[:-1])
+
+        # Literal bytes every header's first line starts with,
+        # short of any line break so CRLF files match too
+        start_literal = ""
+        for element in key_sequence:
+            if element in placeholders or "\n" in element[:-1]:
+                break
+            if element.endswith("\n"):
+                start_literal += element[:-1]
+                break
+            start_literal += element
+
+        self.start_literal = start_literal.encode(header_encoding)
+
+        # The longest run of literal text within one header line. A file
+        # without it anywhere has no headers, see HeaderScanner.might_match.
+        # None when an element spans a line break, so nothing can match.
+        self.anchor = b""
+        run = ""
+        for element in key_sequence:
+            if element not in placeholders and "\n" in element[:-1]:
+                self.anchor = None
+                break
+
+            if element in placeholders:
+                run = ""
+                continue
+
+            run += element.rstrip("\n")
+            if len(run.encode(header_encoding)) > len(self.anchor):
+                self.anchor = run.encode(header_encoding)
+            if element.endswith("\n"):
+                run = ""
+
+    def placeholder_values(self, groups, keys : list[tuple[str, bool]]) -> dict[str, str]:
+
+        values = {}
+
+        for value, (key, takes_rest) in zip(groups, keys):
+
+            if takes_rest:
+                value = value.strip()
+            elif value != value.strip():
+                # Surrounding whitespace never lines up with the next element
+                return None
+
+            if key == self.section_header.key_number:
+                try:
+                    values[key] = int(value)
+                except ValueError:
+                    return None
+            else:
+                # Only descriptions are ever decoded
+                values[key] = value.decode(header_encoding, errors= "replace")
+
+        return values
+
+    def match_line(self, line_index : int, line : bytes) -> dict[str, str]:
+        """Match header line line_index, returning the placeholder values or None"""
+
+        match = self.line_patterns[line_index].match(line)
+        if match is None:
+            return None
+
+        return self.placeholder_values(match.groups(), self.line_keys[line_index])
+
+    def match_header(self, data : bytes, pos : int) -> tuple[dict[str, str], int, int]:
+        """Match a whole header at pos, returning the placeholder values,
+        the start of the last header line and the end of the header match"""
+
+        match = self.header_pattern.match(data, pos)
+        if match is None:
+            return None
+
+        groups = match.groups()
+        groups = groups[:self.last_line_group] + groups[self.last_line_group + 1:]
+
+        values = self.placeholder_values(groups, self.header_keys)
+        if values is None:
+            return None
+
+        return values, match.start("last_line"), match.end()
+
+    def rewrite_header(self, header : bytes, number : int = None, description : str = None) -> bytes:
+        """The bytes of a header found in a file, with its number and
+        description replaced where given. Everything else, line breaks and
+        whitespace around the values included, is kept as it was.
+        Raises ValueError for values the header could not be found with again."""
+
+        match = self.header_pattern.match(header)
+        if match is None:
+            raise ValueError("not a header of this dialect")
+
+        values = {}
+        if number is not None:
+            values[self.section_header.key_number] = str(int(number)).encode(header_encoding)
+        if description is not None:
+            values[self.section_header.key_description] = description.encode(header_encoding)
+
+        # Group numbers of the placeholders, around the last_line marker
+        groups = [index + 1 for index in range(len(self.header_keys) + 1) if index != self.last_line_group]
+
+        parts = []
+        pos = 0
+        for group, (key, takes_rest) in zip(groups, self.header_keys):
+            value = values.get(key)
+            if value is None:
+                continue
+
+            start, end = match.span(group)
+            if takes_rest:
+                # Only the stripped value is replaced
+                captured = header[start:end]
+                start += len(captured) - len(captured.lstrip())
+                end -= len(captured) - len(captured.rstrip())
+
+            parts.append(header[pos:start])
+            parts.append(value)
+            pos = end
+
+        parts.append(header[pos:])
+        rewritten = b"".join(parts)
+
+        found = self.match_header(rewritten, 0)
+        if found is None or found[2] != match.end() + len(rewritten) - len(header):
+            raise ValueError(f"number {number!r} or description {description!r} does not fit the header")
+
+        return rewritten
 
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
@@ -41,6 +300,8 @@ class SectionHeader:
 
 if __name__ == "__main__":
 
+    from enum import Enum
+
     class HeaderElement(Enum):
         HEADER_START = "//" + "~"*70 + "+"
         HEADER_END = "//" + "~"*70 + "-"
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import contextlib
+import threading
+import time
+from collections.abc import Callable
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 1
+# section_description: Instrumentation
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+# Called as hook(kind, name, value), kind being "count" or "time"
+Hook = Callable[[str, str, float], None]
+
+class Instrumentation:
+    """Counters and timers for the work the sectioner does, off by default.
+
+    While disabled, count and record return straight away and timer hands
+    back a shared no-op context manager. Hot loops check enabled before
+    calling in at all. Hooks see every event as it happens, for a service
+    that exports them elsewhere, and snapshot gives the totals so far.
+
+    Totals are updated under a lock, syncs run in executor threads. Worker
+    processes have totals of their own: they take them and send them to
+    the parent, which merges them into its own.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.counters : dict[str, int] = {}
+
+        # Name to [calls, total seconds, longest seconds]
+        self.timers : dict[str, list] = {}
+
+        self.hooks : list[Hook] = []
+        self.null_timer = contextlib.nullcontext()
+        self.lock = threading.Lock()
+
+    def enable(self, hook : Hook = None) -> None:
+        self.enabled = True
+        if hook is not None:
+            self.hooks.append(hook)
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    def count(self, name : str, amount : int = 1) -> None:
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+        for hook in self.hooks:
+            hook("count", name, amount)
+
+    def record(self, name : str, seconds : float) -> None:
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, 0., 0.]
+
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+        for hook in self.hooks:
+            hook("time", name, seconds)
+
+    def timer(self, name : str):
+        """Context manager that records how long its block took"""
+
+        if not self.enabled:
+            return self.null_timer
+
+        return self.timed(name)
+
+    @contextlib.contextmanager
+    def timed(self, name : str):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "timers": {
+                    name: {"calls": calls, "total_seconds": total, "max_seconds": longest}
+                    for name, (calls, total, longest) in self.timers.items()
+                }
+            }
+
+    def take(self) -> dict:
+        """The totals so far, as merge takes them, resetting them.
+        For a worker process to send to its parent."""
+
+        with self.lock:
+            taken = {"counters": self.counters, "timers": self.timers}
+            self.counters = {}
+            self.timers = {}
+
+        return taken
+
+    def merge(self, taken : dict) -> None:
+        """Add totals taken in another process to these, hooks are not called"""
+
+        with self.lock:
+            for name, amount in taken["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+            for name, (calls, total, longest) in taken["timers"].items():
+                timer = self.timers.get(name)
+                if timer is None:
+                    timer = self.timers[name] = [0, 0., 0.]
+
+                timer[0] += calls
+                timer[1] += total
+                timer[2] = max(timer[2], longest)
+
+# Shared by every module, enabled from the command line or by an embedding service
+metrics = Instrumentation()
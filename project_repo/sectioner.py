@@ -1,244 +1,1228 @@
 from __future__ import annotations
 
+import hashlib
 import os
-import shutil
+import time
 from pathlib import Path
 
 from header import SectionHeader
-from file_class import MasterFile, SectionFile, parse_master_file_headers
-
-from icecream import ic
-
-import argparse
-
-dir_working = Path(os.getcwd()).resolve()
-
-parser = argparse.ArgumentParser(description='Maintain section files.')
-parser.add_argument('dirs', metavar='d', type=str, nargs='*', default= ["."],
-                    help='directories or files to manage')
-
-args = parser.parse_args()
-
-# Define section header objects
-python_header = SectionHeader(
-    key_sequence= [
-        "# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n",
-        "# section number     : ",
-        "___number___",
-        "\n",
-        "# section description: ",
-        "___description___",
-        "\n",
-        "# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"
-    ],
-    key_number="___number___",
-    key_description="___description___"
+from file_class import (
+    MasterFile,
+    MonitoredFile,
+    SectionFile,
+    SectionsSnapshot,
+    SectionTable,
+    HeaderSpecifier,
+    HeaderParser,
+    HeaderScanner,
+    count_newlines,
+    line_content_end,
+    change_detectors,
+    DigestChangeDetector,
+    file_digest,
+    file_identity,
+    is_section_file_name,
+    discover_master_file,
+    discover_in_worker,
+    init_discovery_worker
 )
+from cache import ParseCache, default_cache_path
+from discovery import iter_candidate_files, default_excludes
+from dialects import DialectRegistry, default_dialects
 
-st_header = SectionHeader(
-    key_sequence= [
-        "// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~\n",
-        "// section number     : ",
-        "___number___",
-        "\n",
-        "// section description: ",
-        "___description___",
-        "\n",
-        "// ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~"
-    ],
-    key_number="___number___",
-    key_description="___description___"
-)
-
-all_section_headers = [
-    python_header,
-    st_header
-]
+from instrumentation import metrics
 
-def get_master_files(directories : list[str], headers : list[SectionHeader]) -> list[MasterFile]:
+# Importing this module only defines things. The command line is read
+# by main, and modules only some runs need, like shutil, argparse,
+# multiprocessing and asyncio, are imported where they are used, so
+# short runs from editor hooks start quickly.
 
-    ic(headers)
-    input_dirs = directories
+# When staged section files are flushed to disk before being renamed in.
+# none leaves it to the OS, batch syncs once every file is written and
+# per-file syncs each file as soon as it is written.
+fsync_policies = ("none", "batch", "per-file")
 
-    # Evaluate directories and convert to Path class objects
-    pops = []
-    for i, dir in enumerate(input_dirs):
+# Files handed to a discovery worker at a time
+discovery_chunksize = 16
 
-        if dir == ".":
-            pops.append(i)
-            for d in os.listdir(dir_working):
-                if Path(dir).joinpath(d).is_file():
-                    input_dirs.append(Path(dir).joinpath(d).resolve())
+# The dialects the command line scans for, see dialects.default_dialects
+section_dialects = default_dialects()
 
-        elif Path(dir).is_dir():
-            pops.append(i)
-            for d in os.listdir(dir):
-                if Path(dir).joinpath(d).is_file():
-                    input_dirs.append(Path(dir).joinpath(d).resolve())
+python_header = section_dialects.comment_headers["#"]
+st_header = section_dialects.comment_headers["//"]
 
-        elif Path(dir).is_file():
-            input_dirs[i] = Path(dir).resolve()
+all_section_headers = section_dialects.headers
 
-        else:
-            pops.append(i)
+def get_master_files(
+        directories : list[str],
+        headers : list[SectionHeader] = None,
+        cache : ParseCache = None,
+        workers : int = None,
+        include : list[str] = (),
+        exclude : list[str] = default_excludes,
+        dialects : DialectRegistry = None
+    ) -> list[MasterFile]:
+    """Master files under directories. With dialects each file is only
+    scanned for the headers its type or shebang routes it to, out of
+    headers, which defaults to all of theirs. Without, every file is
+    scanned for headers. Given neither, the command line's section_dialects
+    are used."""
 
-    for i in sorted(pops, reverse=True):
-        input_dirs.pop(i)
+    start = time.perf_counter()
 
-    ic(input_dirs)
+    if headers is None:
+        if dialects is None:
+            dialects = section_dialects
+        headers = dialects.headers
 
     master_files : list[MasterFile] = []
 
-    for file in input_dirs:
-        ic("processing file", file)
-        new_master_file = MasterFile(file)
-        added = False
-        if new_master_file.lines_readable:
-
-            ic("readable ok ok ok", headers)
-            for header in headers:
-                if not added:
-                    new_master_file.section_header = header
-                    new_headers = parse_master_file_headers(new_master_file)
-                    for header in new_headers:
-                        print(header.__dict__)
-                    if new_master_file.sections:
-                        added = True
-                        master_files.append(new_master_file)
+    # One read per file finds the headers of every dialect at once
+    scanner = HeaderScanner(headers)
+
+    cache_path = cache.path.resolve() if cache is not None else None
+
+    # Walk order, so masters come back in the same order however they were found
+    walk_order : dict[Path, int] = {}
+    uncached_files : list[Path] = []
+
+    def candidates():
+        """Files the walk finds that still need a scan, yielded as they are found"""
+
+        for file in iter_candidate_files(directories, include= include, exclude= exclude):
+            if file == cache_path:
+                continue
+
+            walk_order[file] = len(walk_order)
+
+            if cache is not None:
+                identity = file_identity(file)
+                cached = cache.lookup(file, identity) if identity is not None else None
+                if cached is not None:
+                    header, header_specifiers, section_digests, digest = cached
+                    if header is not None:
+                        cached_master_file = MasterFile(file)
+                        # A touch of the unchanged master is then no change
+                        cached_master_file.prev_state = (identity[0], identity[1], digest)
+                        cached_master_file.section_header = header
+                        cached_master_file.header_specifiers = header_specifiers
+                        cached_master_file.header_identity = identity
+                        cached_master_file.section_digests = section_digests
+                        master_files.append(cached_master_file)
+                    continue
+
+            uncached_files.append(file)
+            yield file
+
+    if workers is not None and workers > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Chunks go to the workers as the walk yields them, and results
+        # come back in submission order. Workers start from a fresh
+        # interpreter, since forking while watching would copy locks
+        # other threads may hold.
+        with ProcessPoolExecutor(
+            max_workers= workers,
+            mp_context= multiprocessing.get_context("spawn"),
+            initializer= init_discovery_worker,
+            initargs= (headers, dialects, metrics.enabled)
+        ) as executor:
+            results = list(executor.map(discover_in_worker, candidates(), chunksize= discovery_chunksize))
+
+        for *_, taken in results:
+            if taken is not None:
+                metrics.merge(taken)
+
+        discovered = zip(uncached_files, (result[:3] for result in results))
+
+    else:
+        discovered = ((file, discover_master_file(file, scanner, dialects)) for file in candidates())
+
+    for file, (identity, new_master_file, header_index) in discovered:
 
+        if new_master_file is None:
+            # Files without headers are cached too
+            if cache is not None:
+                cache.store(file, identity)
+            continue
+
+        # Workers send back copies, point at the caller's own header
+        new_master_file.section_header = headers[header_index]
+        master_files.append(new_master_file)
+
+    master_files.sort(key= lambda master_file: walk_order[master_file.path])
+
+    metrics.count("candidate_files", len(walk_order))
+    metrics.record("discovery", time.perf_counter() - start)
     return master_files
 
-def make_empty_dir(dir):
-    # Check whether the specified path exists or not
-    if os.path.exists(dir):
-        shutil.rmtree(dir)
+def section_lines_content(lines : list[bytes]) -> bytes:
+    """Section code from its lines, byte for byte as in the master file.
+    The line ending after the last line belongs to the master file, as
+    with the byte range of the section, so it is left off."""
+
+    content = b"".join(lines)
+    if content.endswith(b"\r\n"):
+        return content[:-2]
+    if content.endswith(b"\n"):
+        return content[:-1]
+
+    return content
+
+def section_file_matches(master_file : MasterFile, entry : os.DirEntry, size : int, digest : bytes) -> bool:
+    """True when the section file on disk already holds content of size
+    and digest. Size is compared first, then the digest of the file. The
+    digest of a file this process wrote is remembered until the file's
+    size or mtime changes."""
+
+    metrics.count("stat_calls")
+    stat = entry.stat()
+    if stat.st_size != size:
+        return False
+
+    recorded = master_file.section_digests.get(entry.name)
+    if recorded is not None and recorded[:2] == (stat.st_size, stat.st_mtime_ns):
+        on_disk_digest = recorded[2]
+    else:
+        on_disk_digest = file_digest(entry.path)
+
+    if on_disk_digest != digest:
+        return False
+
+    master_file.section_digests[entry.name] = (stat.st_size, stat.st_mtime_ns, on_disk_digest)
+    return True
+
+def fsync_path(path : Path) -> None:
+    """fsync a file or directory by path"""
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def stage_section_file(staging_dir : Path, name : str, content, fsync : str = "none") -> Path:
 
-    os.mkdir(dir)
+    staged_path = staging_dir.joinpath(name)
+    with open(staged_path, "wb") as f:
+        f.write(content)
+        if fsync == "per-file":
+            f.flush()
+            os.fsync(f.fileno())
+
+    return staged_path
+
+def record_section_file(master_file : MasterFile, index : int, name : str, digest : bytes) -> None:
+
+    metrics.count("stat_calls")
+    stat = os.stat(master_file.dir_master_sections.joinpath(name))
+    master_file.section_digests[name] = (stat.st_size, stat.st_mtime_ns, digest)
+
+    # Sections with no SectionFile yet get their state from section_digests when one is made
+    section = master_file.sections.made_section(index)
+    if section is not None:
+        section.reset_change_state(master_file.section_digests[name])
+
+def make_staging_dir(master_file : MasterFile) -> tuple[dict[str, os.DirEntry], Path]:
+    """The section files in the sections directory, and an empty staging
+    directory next to it for the section files that change. Other files
+    there, editor backups and swap files, are not section files and
+    are left alone."""
+
+    import shutil
+
+    sections_dir = master_file.dir_master_sections
+    os.makedirs(sections_dir.parent, exist_ok= True)
+
+    existing : dict[str, os.DirEntry] = {}
+    if sections_dir.is_dir():
+        existing = {
+            entry.name: entry
+            for entry in os.scandir(sections_dir)
+            if is_section_file_name(entry.name, master_file.filetype) and entry.is_file()
+        }
+    else:
+        master_file.section_digests = {}
+
+    # Created like any other directory, it may become the sections directory
+    staging_dir = sections_dir.parent.joinpath(f".{sections_dir.name}.{os.getpid()}.staging")
+    shutil.rmtree(staging_dir, ignore_errors= True)
+    os.mkdir(staging_dir)
+
+    return existing, staging_dir
+
+def install_staged_files(
+        master_file : MasterFile,
+        staging_dir : Path,
+        staged : list[tuple[int, str, bytes]],
+        leftover : dict[str, os.DirEntry],
+        fsync : str = "none"
+    ) -> None:
+    """Rename the staged section files into the sections directory, or
+    the staging directory itself if there is none yet, and remove the
+    leftover files that no longer have a section.
+
+    staged holds the section index, file name and digest of each staged file.
+    Sections with the same number and description share a file name, the
+    last of them staged is the one the file holds."""
+
+    sections_dir = master_file.dir_master_sections
+
+    # Digest of each staged file name, as the last section staged under it left it
+    digests = {name: digest for _, name, digest in staged}
+
+    if fsync == "batch":
+        for name in digests:
+            fsync_path(staging_dir.joinpath(name))
+
+    if not sections_dir.is_dir():
+        os.rename(staging_dir, sections_dir)
+    else:
+        for name in digests:
+            os.replace(staging_dir.joinpath(name), sections_dir.joinpath(name))
+
+    for index, name, _ in staged:
+        record_section_file(master_file, index, name, digests[name])
+
+    for name, entry in leftover.items():
+        os.remove(entry.path)
+        metrics.count("sections_removed")
+        master_file.section_digests.pop(name, None)
+
+    # The renames themselves
+    if fsync != "none" and (staged or leftover):
+        fsync_path(sections_dir)
+
+    # Looked at afresh next time, against what was just written
+    master_file.sections_snapshot = None
+
+def generate_section_files(master_file : MasterFile, use_mmap : bool = False, fsync : str = "none") -> None:
+    """Bring the sections directory in line with master_file.sections,
+    only creating, rewriting or deleting the files that differ.
+
+    Changed files are written whole into a staging directory next to
+    the sections directory and renamed over the old ones, so a reader
+    never sees a partly written section. A sections directory that does
+    not exist yet is staged in full and renamed into place at once."""
+
+    import shutil
+
+    existing, staging_dir = make_staging_dir(master_file)
+
+    sections = master_file.sections
+    table = master_file.header_specifiers
+
+    try:
+        # Section index, file name and the digest of the content it was staged with, in master file order
+        staged : list[tuple[int, str, bytes]] = []
+
+        def update(index : int, name : str, content) -> None:
+            digest = hashlib.blake2b(content, digest_size= 16).digest()
+            entry = existing.pop(name, None)
+            if entry is None or not section_file_matches(master_file, entry, len(content), digest):
+                stage_section_file(staging_dir, name, content, fsync= fsync)
+                if metrics.enabled:
+                    metrics.count("sections_written")
+                    metrics.count("bytes_written", len(content))
+                staged.append((index, name, digest))
+
+        # Names and content come straight from the section table,
+        # no SectionFile objects are made for writing
+        if not use_mmap:
+            for index, name in enumerate(sections.names()):
+                update(index, name, section_lines_content(sections.section_lines(index)))
+
+        else:
+            # Each section is compared and staged straight from a slice of the mapped master file
+            code_start_bytes = table.column("code_start_byte")
+            code_end_bytes = table.column("code_end_byte")
 
-def generate_section_files(master_file : MasterFile) -> None:
+            with master_file.open_map() as mapped:
+                for index, name in enumerate(sections.names()):
+                    if code_start_bytes[index] == table.none_value:
+                        update(index, name, b"")
+                        continue
+                    with mapped.view(code_start_bytes[index], code_end_bytes[index]) as view:
+                        update(index, name, view)
 
-    make_empty_dir(master_file.dir_master_sections)
+        # Whatever is left in existing no longer has a section in the master file
+        install_staged_files(master_file, staging_dir, staged, existing, fsync= fsync)
+
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors= True)
+
+# Bytes of the master file read at a time when streaming
+stream_chunk_size = 1 << 20
+
+# Blank and partial header lines held in memory while streaming, until
+# a code line shows they are part of a section. Past this they are
+# written out, and cut off the file again if no code line follows.
+stream_pending_limit = 1 << 16
+
+class StreamedSectionFile:
+    """A section file being written as its master file is read.
+
+    Code is written as it arrives. What comes between code lines is
+    held back, since trailing blank lines are not part of the section,
+    and so is the line break after the last code line.
+
+    Without a path the content is only digested, for a section that
+    likely matches its file on disk already."""
+
+    __slots__ = ("path", "file", "digest", "size", "written", "pending", "pending_size")
+
+    def __init__(self, path : Path = None) -> None:
+        self.path = path
+        self.file = open(path, "wb", buffering= 1 << 16) if path is not None else None
+        self.digest = hashlib.blake2b(digest_size= 16)
+
+        # Bytes of section content, and bytes in the file or digested
+        self.size = 0
+        self.written = 0
+
+        self.pending : list[bytes] = []
+        self.pending_size = 0
+
+    def hold(self, data) -> None:
+
+        if not data:
+            return
+
+        self.pending.append(bytes(data))
+        self.pending_size += len(data)
+
+        if self.pending_size > stream_pending_limit:
+            # Part of it may be cut off again, so the digest
+            # is taken once the content is complete
+            self.digest = None
+            self.write_pending()
+
+    def write_pending(self) -> None:
+
+        for data in self.pending:
+            self.write(data)
+
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, data) -> None:
+
+        if self.file is not None:
+            self.file.write(data)
+        if self.digest is not None:
+            self.digest.update(data)
+        self.written += len(data)
+
+    def write_code(self, data) -> None:
+        """Write code that ends the section so far, along with what was held back before it"""
+
+        self.write_pending()
+        self.write(data)
+        self.size = self.written
+
+    def finish(self, fsync : str = "none") -> bytes:
+        """Close the file, returning the digest of its content, or None
+        when only digesting and the digest could not be kept"""
+
+        if self.file is None:
+            return self.digest.digest() if self.digest is not None else None
+
+        if self.written > self.size:
+            self.file.truncate(self.size)
+
+        if fsync == "per-file":
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+        if self.digest is None:
+            return file_digest(self.path)
+
+        return self.digest.digest()
+
+    def discard(self) -> None:
+
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.path)
+
+class SectionStreamer:
+    """Finds the headers of a master file in chunks of it, writing each
+    section's code to a StreamedSectionFile in the staging directory as
+    soon as it is read.
+
+    Runs of lines that can not start a header are recorded with
+    HeaderParser.feed_code_lines and copied out whole, only lines that
+    start with the header's start literal, and the header lines after
+    them, go through the parser one at a time."""
+
+    def __init__(
+            self,
+            master_file : MasterFile,
+            staging_dir : Path,
+            existing : dict[str, os.DirEntry],
+            fsync : str = "none"
+        ) -> None:
+
+        self.master_file = master_file
+        self.staging_dir = staging_dir
+        self.existing = existing
+        self.fsync = fsync
+
+        self.parser = HeaderParser(master_file.section_header)
+        self.start_literal = master_file.section_header.compile().start_literal or None
+        self.line_start_literal = b"\n" + self.start_literal if self.start_literal is not None else None
+
+        # Line number and file offset of the data being fed
+        self.line_num = 0
+        self.offset = 0
+
+        self.index = -1
+        self.current : StreamedSectionFile = None
+        self.current_name : str = None
+        self.current_header_specifier : HeaderSpecifier = None
+
+        # Opened to copy out sections that were only digested but differ
+        self.source = None
+
+        # Section index, file name and digest of each staged file
+        self.staged : list[tuple[int, str, bytes]] = []
+
+    def feed(self, data, end : int) -> None:
+        """Feed the whole lines in data[:end], starting at self.offset"""
+
+        pos = 0
+        while pos < end:
+
+            if self.start_literal is not None and self.parser.idle:
+                # The next line that could start a header
+                if data.startswith(self.start_literal, pos):
+                    candidate = pos
+                else:
+                    candidate = data.find(self.line_start_literal, pos, end)
+                    candidate = end if candidate == -1 else candidate + 1
+
+                if candidate > pos:
+                    self.feed_code(data, pos, candidate)
+                    pos = candidate
+                    continue
+
+            line_end = data.find(b"\n", pos, end)
+            line_end = end if line_end == -1 else line_end + 1
+            self.feed_line(data[pos:line_end], self.offset + pos)
+            pos = line_end
+
+        self.offset += end
+
+    def feed_code(self, data, start : int, end : int) -> None:
+
+        header_specifier = self.parser.new_header_specifier
+        if header_specifier is None:
+            self.parser.feed_code_lines(self.line_num, self.offset + start, data, start, end)
+            self.line_num += count_newlines(data, start, end)
+            return
+
+        code_end_byte = header_specifier.code_end_byte
+        self.parser.feed_code_lines(self.line_num, self.offset + start, data, start, end)
+        self.line_num += count_newlines(data, start, end)
+
+        if header_specifier.code_end_byte != code_end_byte:
+            code_start = max(header_specifier.code_start_byte - self.offset, start)
+            code_end = header_specifier.code_end_byte - self.offset
+            self.current.write_code(data[code_start:code_end])
+            self.current.hold(data[code_end:end])
+
+        # Blank lines, only part of the section if code follows
+        elif header_specifier.code_start_line is not None:
+            self.current.hold(data[start:end])
+
+    def feed_line(self, line : bytes, line_start : int) -> None:
+
+        header_specifier = self.parser.new_header_specifier
+        line_num = self.line_num
+        self.line_num += 1
+
+        self.parser.feed(line_num, line_start, line)
+
+        if self.parser.new_header_specifier is not header_specifier:
+            # A header completed, the section before it is done
+            self.finish_section()
+            self.start_section(self.parser.new_header_specifier)
+
+        elif header_specifier is None:
+            return
+
+        elif header_specifier.code_end_line == line_num:
+            content_end = line_content_end(line)
+            self.current.write_code(line[:content_end])
+            self.current.hold(line[content_end:])
+
+        # Blank or partial header lines, only part of the section if code follows
+        elif header_specifier.code_start_line is not None:
+            self.current.hold(line)
+
+    def start_section(self, header_specifier : HeaderSpecifier) -> None:
+
+        self.index += 1
+        self.current_name = f"{header_specifier.section_number}__{header_specifier.section_description}.{self.master_file.filetype}"
+        self.current_header_specifier = header_specifier
+
+        # Sections with a file already are digested, and only written if they differ
+        if self.current_name in self.existing:
+            self.current = StreamedSectionFile()
+        else:
+            self.current = StreamedSectionFile(self.staging_dir.joinpath(self.current_name))
 
-    for section in master_file.sections:
+    def finish_section(self) -> None:
+        """Keep the current section's staged file if it differs from the one on disk"""
 
-        with open(section.path, "w") as f:
-            if section.lines:
-                for line_number, line in enumerate(section.lines):
-                    if line_number < len(section.lines) - 1:
-                        f.write(line + "\n")
-                    else:
-                        f.write(line)
-            else:
-                f.write("")
+        current = self.current
+        if current is None:
+            return
 
-        section.prev_mod_time = section.get_mod_time()
+        self.current = None
+        digest = current.finish(fsync= self.fsync)
+
+        entry = self.existing.pop(self.current_name, None)
+        if entry is not None and digest is not None \
+            and section_file_matches(self.master_file, entry, current.size, digest):
+                if current.path is not None:
+                    os.remove(current.path)
+                return
+
+        if current.path is None:
+            # Only digested, the code is copied out of the master after all
+            digest = self.copy_section(self.current_header_specifier)
+
+        if metrics.enabled:
+            metrics.count("sections_written")
+            metrics.count("bytes_written", current.size)
+        self.staged.append((self.index, self.current_name, digest))
+
+    def copy_section(self, header_specifier : HeaderSpecifier) -> bytes:
+        """Stage the code of a section found earlier, returning its digest"""
+
+        if self.source is None:
+            self.source = open(self.master_file.path, "rb")
+
+        staged_path = self.staging_dir.joinpath(self.current_name)
+        with open(staged_path, "wb") as destination:
+            if header_specifier.code_start_byte is not None:
+                copy_range(self.source, destination, header_specifier.code_start_byte, header_specifier.code_end_byte)
+            if self.fsync == "per-file":
+                destination.flush()
+                os.fsync(destination.fileno())
+
+        return file_digest(staged_path)
+
+    def run(self, f, digest = None) -> None:
+        """Feed the whole of the open file f, a chunk at a time, updating
+        the hash object digest with each chunk when it is given"""
+
+        carry = b""
+        while True:
+            chunk = f.read(stream_chunk_size)
+            metrics.count("bytes_read", len(chunk))
+            if digest is not None:
+                digest.update(chunk)
+
+            data = carry + chunk if carry else chunk
+
+            # A line cut off at the end of the chunk waits for the next one
+            end = data.rfind(b"\n") + 1 if chunk else len(data)
+            self.feed(data, end)
+            carry = data[end:]
+
+            if not chunk:
+                break
+
+        self.finish_section()
+
+    def close(self) -> None:
+        """Remove a section file left partly written"""
+
+        if self.current is not None:
+            self.current.discard()
+            self.current = None
+
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+def stream_section_files(master_file : MasterFile, fsync : str = "none") -> tuple[int, int, bytes]:
+    """Find the headers of master_file and write its section files in a
+    single pass over it, read in chunks rather than whole, so masters of
+    any size are sectioned in bounded memory.
+
+    Each section is streamed into a staged file as it is read, and kept
+    only if it differs from the section file on disk. The staged files
+    are then installed as generate_section_files does. The header
+    specifiers are left as a parse would have found them.
+
+    Returns the change state of the master as it was read. The digest
+    change detector's digest is taken in the same pass."""
+
+    import shutil
+
+    existing, staging_dir = make_staging_dir(master_file)
+    streamer = SectionStreamer(master_file, staging_dir, existing, fsync= fsync)
+    digest = hashlib.blake2b(digest_size= 16) if isinstance(master_file.change_detector, DigestChangeDetector) else None
+
+    try:
+        with open(master_file.path, "rb", buffering= 0) as f:
+            before = os.fstat(f.fileno())
+            streamer.run(f, digest= digest)
+            after = os.fstat(f.fileno())
+
+        # Offsets are only good if the file did not change while it was read
+        identity = (after.st_size, after.st_mtime_ns, after.st_ino)
+        unchanged = identity == (before.st_size, before.st_mtime_ns, before.st_ino)
+
+        master_file.header_specifiers = SectionTable.from_specifiers(streamer.parser.finish())
+        master_file.header_identity = identity if unchanged else None
+        master_file.load_sections()
+
+        # Whatever is left in existing no longer has a section in the master file
+        install_staged_files(master_file, staging_dir, streamer.staged, existing, fsync= fsync)
+
+    finally:
+        streamer.close()
+        shutil.rmtree(staging_dir, ignore_errors= True)
+
+    # A change made while reading leaves no digest, so the next check sees it
+    return before.st_size, before.st_mtime_ns, digest.digest() if digest is not None and unchanged else None
 
 def get_parent_dirs(master_files : list[MasterFile]) -> list[Path]:
 
     return list(set(m.path.parent.resolve() for m in master_files))
 
-def build_sections(master_file : MasterFile) -> None:
+def build_sections(
+        master_file : MasterFile,
+        use_mmap : bool = False,
+        fsync : str = "none",
+        stream : bool = False
+    ) -> None:
+
+    with metrics.timer("build"):
+        if stream:
+            state = stream_section_files(master_file= master_file, fsync= fsync)
+        else:
+            # Taken before parsing, a change made meanwhile is seen on the next check
+            state = master_file.change_detector.state(master_file.path)
+            master_file.parse(use_mmap= use_mmap)
+            generate_section_files(master_file= master_file, use_mmap= use_mmap, fsync= fsync)
+        master_file.reset_change_state(state)
 
-    print("build")
+def copy_range(source, destination, start : int, end : int) -> None:
+    """Copy bytes start to end of one open file to the end of another,
+    in the kernel where os.copy_file_range is available"""
 
-    master_file.parse()
-    make_empty_dir(master_file.dir_master_sections)
-    generate_section_files(master_file= master_file)
+    remaining = end - start
 
-def detect_all_section_files(master_file : MasterFile) -> list[SectionFile]:
+    if hasattr(os, "copy_file_range"):
+        destination.flush()
+        offset = start
+        while remaining > 0:
+            try:
+                copied = os.copy_file_range(source.fileno(), destination.fileno(), remaining, offset)
+            except OSError:
+                break
+            if copied == 0:
+                break
+            offset += copied
+            remaining -= copied
+        start = offset
+        destination.seek(0, os.SEEK_END)
 
-    return_files : list[SectionFile] = []
+    source.seek(start)
+    while remaining > 0:
+        chunk = source.read(min(remaining, 1 << 20))
+        if not chunk:
+            break
+        destination.write(chunk)
+        remaining -= len(chunk)
 
-    for path in os.listdir(master_file.dir_master_sections):
+def section_edit_range(master_file : MasterFile, section : SectionFile, content : bytes) -> tuple[int, int, bytes]:
+    """Byte range of the master file that section content replaces, and the bytes to put there"""
 
+    header_specifier = section.header_specifier
+
+    # Editors usually end the file with a line break that
+    # generate_section_files does not write, the master already has it
+    if content.endswith(b"\r\n"):
+        content = content[:-2]
+    elif content.endswith(b"\n"):
+        content = content[:-1]
+
+    if header_specifier.code_start_byte is not None:
+        return header_specifier.code_start_byte, header_specifier.code_end_byte, content
+
+    if not content:
+        return None
+
+    # A section without code gets its first lines right after its header
+    start = header_specifier.header_end_byte
+    with open(master_file.path, "rb") as f:
+        f.seek(max(start - 2, 0))
+        header_line_end = f.read(start - max(start - 2, 0))
+
+    line_break = b"\r\n" if header_line_end.endswith(b"\r\n") else b"\n"
+    if header_line_end.endswith(b"\n"):
+        return start, start, content + line_break
+
+    return start, start, line_break + content
+
+def splice_sections_into_master(master_file : MasterFile, sections : list[SectionFile], use_mmap : bool = False) -> None:
+    """Write edited section files back into their master file.
+
+    When every edit keeps its byte length the master is patched in place.
+    Otherwise a new master is streamed to a temporary file, copying the
+    unchanged byte ranges across, and renamed over the old one."""
+
+    import shutil
+
+    splice_start = time.perf_counter()
+
+    edits = []
+    for section in sections:
+        with open(section.path, "rb") as f:
+            content = f.read()
+
+        # The section file now matches the master, as if it had been written from it
+        stat = os.stat(section.path)
+        master_file.section_digests[section.path.name] = (
+            stat.st_size,
+            stat.st_mtime_ns,
+            hashlib.blake2b(content, digest_size= 16).digest()
+        )
+
+        edit = section_edit_range(master_file, section, content)
+        if edit is not None:
+            edits.append(edit)
+
+    master_file.sections_snapshot = None
+
+    edits.sort()
+
+    if all(len(content) == end - start for start, end, content in edits):
+        with open(master_file.path, "r+b") as f:
+            for start, _, content in edits:
+                f.seek(start)
+                f.write(content)
+
+    else:
+        size = os.stat(master_file.path).st_size
+        temporary_path = master_file.path.with_name(f".{master_file.path.name}.splice")
+
+        # The master is only replaced once the new one is written whole
         try:
-            new_section_file = SectionFile(
-                path= master_file.dir_master_sections.joinpath(path),
-                section_number= int(path.split("__")[0]),
-                section_description= path[path.index("__"):].split(".")[0],
-                master_file= master_file
-            )
-
-        except:
-            continue
+            with open(master_file.path, "rb") as source, open(temporary_path, "wb") as destination:
+                pos = 0
+                for start, end, content in edits:
+                    copy_range(source, destination, pos, start)
+                    destination.write(content)
+                    pos = end
+                copy_range(source, destination, pos, size)
 
-        if new_section_file.lines_readable:
-            return_files.append(new_section_file)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
 
-    return return_files
+        shutil.copymode(master_file.path, temporary_path)
+        os.replace(temporary_path, master_file.path)
 
-if __name__ == "__main__":
+    # Offsets moved. A master patched in place keeps its size and inode,
+    # and may keep its mtime too, so its headers are found again regardless.
+    master_file.header_identity = None
 
-    import time
+    # The master changing here is not an edit to sync back out
+    state = master_file.change_detector.state(master_file.path)
+    master_file.parse(use_mmap= use_mmap)
+    master_file.reset_change_state(state)
 
-    mfiles = get_master_files(directories = args.dirs, headers = all_section_headers)
-    parent_paths = get_parent_dirs(master_files= mfiles)
+    metrics.count("sections_spliced", len(edits))
+    metrics.record("splice", time.perf_counter() - splice_start)
 
-    for path in parent_paths:
-        make_empty_dir(dir= path.joinpath("sections"))
+def rewrite_master_headers(
+        master_file : MasterFile,
+        changes : dict[int, tuple[int, str]],
+        use_mmap : bool = False,
+        fsync : str = "none"
+    ) -> None:
+    """Renumber or re-describe many sections of a master file at once.
+
+    changes maps the index of a header in master_file.header_specifiers
+    to its (new number, new description), either of which may be None to
+    keep it. Every header is rewritten before the master is touched, so a
+    change that can not be made leaves it as it was. When every header
+    keeps its byte length the master is patched in place. Otherwise it is
+    streamed once into a temporary file, copying everything but the
+    replaced headers straight from a memory map, and renamed over the old
+    one. Its sections are then rebuilt."""
 
-    for m in mfiles:
-        build_sections(master_file= m)
+    import shutil
 
-    exit()
+    rewrite_start = time.perf_counter()
+
+    # Header byte offsets are only good for the file they were found in
+    if file_identity(master_file.path) != master_file.header_identity:
+        raise ValueError(f"{master_file.path} changed since its headers were parsed")
+
+    compiled = master_file.section_header.compile()
+    header_specifiers = master_file.header_specifiers
+    temporary_path = master_file.path.with_name(f".{master_file.path.name}.rewrite")
 
     try:
-        while True:
+        with master_file.open_map() as mapped:
 
-            for header_object in all_section_headers:
+            # Byte range of each header, and what replaces it, in file order
+            rewrites : list[tuple[int, int, bytes]] = []
+            for index in sorted(changes):
+                number, description = changes[index]
+                header_specifier = header_specifiers[index]
+                start, end = header_specifier.header_start_byte, header_specifier.header_end_byte
 
-                # Add new master files
-                potential_masters = detect_all_master_files(
-                    dir= dir_this_file_parent,
-                    section_header= python_header
-                )
+                with mapped.view(start, end) as header:
+                    rewrites.append((start, end, compiled.rewrite_header(bytes(header), number, description)))
 
-                for pm in potential_masters:
-                    if pm not in mfiles:
-                        mfiles.append(pm)
+            in_place = all(len(rewritten) == end - start for start, end, rewritten in rewrites)
 
-            # Evaluate all master files
-            pop_indexes = []
+            if not in_place:
+                with open(temporary_path, "wb", buffering= 1 << 20) as destination:
+                    pos = 0
+                    for start, end, rewritten in rewrites:
+                        with mapped.view(pos, start) as unchanged:
+                            destination.write(unchanged)
+                        destination.write(rewritten)
+                        pos = end
 
-            # Detect changes to a master file.
-            # Remove sections if the master file is
-            # deleted
-            for index, mfile in enumerate(mfiles):
+                    with mapped.view(pos, len(mapped.data)) as unchanged:
+                        destination.write(unchanged)
 
-                if mfile.dir_master_sections.is_dir():
+                    if fsync != "none":
+                        destination.flush()
+                        os.fsync(destination.fileno())
 
-                    # Make sure all section files that are present
-                    # match all section files within the scope of master file
-                    section_file_mismatch = False
-                    potential_sections = detect_all_section_files(master_file= mfile)
+    except BaseException:
+        if temporary_path.exists():
+            os.remove(temporary_path)
+        raise
 
-                    for file in potential_sections:
-                        if file not in mfile.sections:
-                            section_file_mismatch = True
+    if in_place:
+        with open(master_file.path, "r+b") as f:
+            for start, _, rewritten in rewrites:
+                f.seek(start)
+                f.write(rewritten)
 
-                    for file in mfile.sections:
-                        if file not in potential_sections:
-                            section_file_mismatch = True
+            if fsync != "none":
+                f.flush()
+                os.fsync(f.fileno())
 
-                else:
-                    make_empty_dir(dir= mfile.dir_master_sections)
-
-                if mfile.path.is_file() \
-                    and (
-                        mfile.detect_file_change()
-                        or not mfile.sections
-                        or section_file_mismatch
-                    ):
-                        mfiles[index] = build_sections(master_file= mfile)
-                else:
-                    make_empty_dir(dir= mfile.dir_master_sections)
-                    os.rmdir(path= mfile.dir_master_sections)
-                    pop_indexes.append(index)
+    else:
+        shutil.copymode(master_file.path, temporary_path)
+        os.replace(temporary_path, master_file.path)
+
+    # Found again even if the master kept its size, inode and mtime
+    master_file.header_identity = None
+
+    metrics.count("headers_rewritten", len(changes))
+    metrics.record("rewrite", time.perf_counter() - rewrite_start)
 
-            for index in sorted(pop_indexes, reverse= True):
-                mfiles.pop(index)
+    build_sections(master_file= master_file, use_mmap= use_mmap, fsync= fsync)
 
-            time.sleep(.1)
+def renumbered(master_file : MasterFile, start : int = 1, step : int = 1) -> dict[int, tuple[int, str]]:
+    """Changes for rewrite_master_headers that number every section
+    in file order from start, leaving headers already right alone"""
+
+    changes = {}
+    for index, section_number in enumerate(master_file.header_specifiers.column("section_number")):
+        number = start + index * step
+        if section_number != number:
+            changes[index] = (number, None)
+
+    return changes
+
+def sections_up_to_date(master_file : MasterFile) -> bool:
+    """True when every section file is exactly as it was last written
+    from the master, by this process or a previous run via the cache.
+    Only valid while the master file itself is unchanged."""
+
+    if not master_file.section_digests or not master_file.dir_master_sections.is_dir():
+        return False
+
+    on_disk = {
+        entry.name: entry.stat()
+        for entry in os.scandir(master_file.dir_master_sections)
+        if is_section_file_name(entry.name, master_file.filetype) and entry.is_file()
+    }
+
+    if set(on_disk) != set(master_file.sections.names()):
+        return False
+
+    for name, stat in on_disk.items():
+        recorded = master_file.section_digests.get(name)
+        if recorded is None or recorded[:2] != (stat.st_size, stat.st_mtime_ns):
+            return False
+
+    return True
+
+def build_stale_sections(
+        master_files : list[MasterFile],
+        use_mmap : bool = False,
+        fsync : str = "none",
+        stream : bool = False
+    ) -> None:
+    """Build the sections of each master file whose section files are not
+    exactly as they were last written. Masters that were cached, with
+    untouched sections, need no rebuild."""
+
+    for master_file in master_files:
+        master_file.load_sections()
+        if not sections_up_to_date(master_file):
+            build_sections(master_file= master_file, use_mmap= use_mmap, fsync= fsync, stream= stream)
+
+def changed_section_files(master_file : MasterFile) -> tuple[bool, list[str]]:
+    """Whether section files of master_file are missing from disk, and
+    the names of the section files there whose size or mtime moved since
+    the last look. Files with other names, and section files of sections
+    the master does not have, are left out.
+
+    The sections directory is only listed when its own mtime moved,
+    otherwise the section files already known are stat'ed and nothing
+    else is done for the ones that did not change."""
+
+    snapshot = master_file.sections_snapshot
+    if snapshot is None:
+        snapshot = master_file.sections_snapshot = SectionsSnapshot.from_digests(master_file.section_digests)
+
+    try:
+        listed, changed = snapshot.refresh(master_file.dir_master_sections, master_file.filetype)
+    except OSError:
+        return True, []
+
+    # The names were compared when the directory was last listed,
+    # and rebuilt if any were missing, so none are otherwise
+    missing = listed and not set(master_file.sections.names()) <= set(snapshot.entries)
+
+    # Files that are gone come back with the rebuild
+    return missing, [name for name in changed if name in snapshot.entries]
+
+def remove_section_files(master_file : MasterFile) -> None:
+    """Remove the section files of a master file that is gone, and its
+    sections directory unless other files are left in it"""
+
+    sections_dir = master_file.dir_master_sections
+    if not sections_dir.is_dir():
+        return
+
+    for entry in os.scandir(sections_dir):
+        if is_section_file_name(entry.name, master_file.filetype) and entry.is_file():
+            os.remove(entry.path)
+            metrics.count("sections_removed")
+
+    master_file.section_digests = {}
+    master_file.sections_snapshot = None
+
+    try:
+        os.rmdir(sections_dir)
+    except OSError:
+        pass
+
+def sync_master_file(
+        master_file : MasterFile,
+        use_mmap : bool = False,
+        fsync : str = "none",
+        stream : bool = False
+    ) -> bool:
+    """Rebuild the sections of a master file that changed, or splice
+    edited section files back into it. Returns False, after removing its sections, if the master file is gone.
+    With stream, sections are rebuilt with stream_section_files and the master is never read in whole."""
+
+    if not master_file.path.is_file():
+        remove_section_files(master_file)
+        return False
+
+    if master_file.detect_file_change() or not master_file.sections:
+        build_sections(master_file= master_file, use_mmap= use_mmap, fsync= fsync, stream= stream)
+        return True
+
+    missing, changed = changed_section_files(master_file)
+
+    # Edits to section files go back into the master, before any rebuild
+    # from it. Only the section files that changed on disk get a
+    # SectionFile to check.
+    if changed:
+        sections = master_file.sections
+        indexes = {name: index for index, name in enumerate(sections.names())}
+        edited_sections = [
+            sections[indexes[name]]
+            for name in changed
+            if name in indexes and sections[indexes[name]].detect_file_change()
+        ]
+        if edited_sections:
+            edited_sections.sort(key= lambda section: indexes[section.path.name])
+            # Only the headers are needed after a splice, found from a map when streaming
+            splice_sections_into_master(master_file, edited_sections, use_mmap= use_mmap or stream)
+
+    # Section files that were deleted are written again
+    if missing:
+        build_sections(master_file= master_file, use_mmap= use_mmap, fsync= fsync, stream= stream)
+
+    return True
+
+def build_parser():
+    """argparse.ArgumentParser for the command line"""
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Maintain section files.')
+    parser.add_argument('dirs', metavar='d', type=str, nargs='*', default= ["."],
+                        help='directories or files to manage')
+    parser.add_argument('--include', action='append', default= [],
+                        help='gitignore style pattern of files to consider, may be repeated')
+    parser.add_argument('--exclude', action='append', default= [],
+                        help='gitignore style pattern of files and directories to skip, may be repeated')
+    parser.add_argument('--mmap', action='store_true',
+                        help='memory map master files and write sections from the map')
+    parser.add_argument('--stream', action='store_true',
+                        help='find headers and write sections in one pass over each master file, '
+                             'holding a line at a time in memory')
+    parser.add_argument('--fsync', choices= fsync_policies, default= "none",
+                        help='flush section files to disk before they replace the old ones: '
+                             'none, batch once all are written, or per-file as each is written')
+    parser.add_argument('--cache', type=str, default= None,
+                        help='file that keeps header scan results between runs, '
+                             'by default one for the directories given in the user cache directory')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='scan every file without reading or writing the cache')
+    parser.add_argument('-j', '--jobs', type=int, default= None,
+                        help='worker processes for discovering and parsing master files')
+    parser.add_argument('--change-detection', choices= list(change_detectors), default= "digest",
+                        help='stat: a file changed when its size or mtime did, '
+                             'digest: also compare content when only the mtime moved')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and sync sections whenever master files change')
+    parser.add_argument('--poll', action='store_true',
+                        help='poll for changes every 0.1s instead of using inotify')
+    parser.add_argument('--rescan', type=float, default= 10.,
+                        help='with --watch, seconds between looking for new master files')
+    parser.add_argument('--shards', type=int, default= 1,
+                        help='with --watch, worker processes to spread master files across, '
+                             'so a slow rebuild only holds up the masters of its own shard')
+    parser.add_argument('--health', type=str, default= None,
+                        help='with --shards, file the status of each shard is written to as JSON every second')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print how long each discovery, parse, build and splice takes')
+    parser.add_argument('--stats', action='store_true',
+                        help='print counters and timings as JSON on exit')
+
+    return parser
+
+def main(argv : list[str] = None) -> None:
+    """Command line entry point, argv defaults to sys.argv[1:]"""
+
+    args = build_parser().parse_args(argv)
+
+    MonitoredFile.change_detector = change_detectors[args.change_detection]
+
+    def print_timing(kind : str, name : str, value : float) -> None:
+        if kind == "time":
+            print(f"{name} {value * 1000:.1f}ms")
+
+    def print_stats() -> None:
+        if args.stats:
+            import json
+            print(json.dumps(metrics.snapshot(), indent= 2))
+
+    if args.verbose or args.stats:
+        metrics.enable(hook= print_timing if args.verbose else None)
+
+    cache = None
+    if not args.no_cache:
+        cache_path = args.cache if args.cache is not None else default_cache_path(args.dirs)
+        cache = ParseCache(path= cache_path, headers= section_dialects.headers)
+        cache.load()
+
+    def discover() -> list[MasterFile]:
+        return get_master_files(
+            directories = args.dirs,
+            cache= cache,
+            workers= args.jobs,
+            include= args.include,
+            exclude= [*default_excludes, *args.exclude],
+            dialects= section_dialects
+        )
+
+    def save_cache(master_files : list[MasterFile]) -> None:
+        if cache is not None:
+            for m in master_files:
+                cache.store_master(m)
+            cache.prune()
+            cache.save()
+
+    mfiles = discover()
+    parent_paths = get_parent_dirs(master_files= mfiles)
+
+    for path in parent_paths:
+        os.makedirs(path.joinpath("sections"), exist_ok= True)
+
+    if args.watch and args.shards > 1:
+        from daemon import ShardedDaemon
+
+        # Each shard builds its own masters, in parallel with the others
+        daemon = ShardedDaemon(
+            master_files= mfiles,
+            shards= args.shards,
+            use_mmap= args.mmap,
+            fsync= args.fsync,
+            stream= args.stream,
+            use_inotify= not args.poll,
+            poll_interval= .1,
+            health_path= args.health,
+            discover= discover,
+            rescan_interval= args.rescan,
+            change_detection= args.change_detection
+        )
+
+        try:
+            daemon.run_forever()
+
+        except KeyboardInterrupt:
+            save_cache(daemon.stop())
+            print_stats()
+
+        return
+
+    build_stale_sections(mfiles, use_mmap= args.mmap, fsync= args.fsync, stream= args.stream)
+    save_cache(mfiles)
+
+    if not args.watch:
+        print_stats()
+        return
+
+    import asyncio
+    import functools
+    from service import SectionerService
+
+    # Sleeps until inotify reports a change, or polls every 0.1s without it
+    service = SectionerService(
+        master_files= mfiles,
+        use_mmap= args.mmap,
+        fsync= args.fsync,
+        poll_interval= .1,
+        use_inotify= not args.poll,
+        sync= functools.partial(sync_master_file, stream= args.stream) if args.stream else sync_master_file,
+        discover= discover,
+        rescan_interval= args.rescan
+    )
+
+    try:
+        asyncio.run(service.run_forever())
 
     except KeyboardInterrupt:
-        exit()
\ No newline at end of file
+        save_cache(service.master_files)
+        print_stats()
+
+if __name__ == "__main__":
+    main()
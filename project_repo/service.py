@@ -0,0 +1,320 @@
+from __future__ import annotations
+
+import asyncio
+import traceback
+from typing import Callable
+
+from file_class import MasterFile
+from instrumentation import metrics
+from watcher import InotifyWatcher, PollingWatcher, make_watcher
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 1
+# section_description: SectionerService
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+class SectionerService:
+    """Keeps the sections of a set of master files in sync from an asyncio loop.
+
+    Changes reported by the watcher are debounced per master file, so a
+    burst of writes from an editor, formatter or git checkout becomes a
+    single sync once the file has been quiet for debounce seconds, or at
+    the latest max_delay seconds after the first write. Syncs run in the
+    loop's default executor, at most max_concurrent at once and never two
+    for the same master file.
+
+    sync is called as sync(master_file, use_mmap, fsync) and returns False
+    once the master file is gone, which removes it from the service.
+    It defaults to sectioner.sync_master_file.
+
+    With discover, master files are discovered again every rescan_interval
+    seconds, in the default executor, and the new ones are added.
+    """
+
+    def __init__(
+            self,
+            master_files : list[MasterFile] = (),
+            use_mmap : bool = False,
+            fsync : str = "none",
+            debounce : float = .05,
+            max_delay : float = 1.,
+            max_concurrent : int = 4,
+            poll_interval : float = .1,
+            use_inotify : bool = True,
+            sync : Callable[[MasterFile, bool, str], bool] = None,
+            discover : Callable[[], list[MasterFile]] = None,
+            rescan_interval : float = 10.
+        ) -> None:
+
+        if sync is None:
+            from sectioner import sync_master_file
+            sync = sync_master_file
+
+        self.master_files : list[MasterFile] = list(master_files)
+        self.use_mmap = use_mmap
+        self.fsync = fsync
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_concurrent = max_concurrent
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.sync = sync
+        self.discover = discover
+        self.rescan_interval = rescan_interval
+
+        self.watcher : InotifyWatcher | PollingWatcher = None
+        self.loop : asyncio.AbstractEventLoop = None
+        self.semaphore : asyncio.Semaphore = None
+        self.poll_task : asyncio.Task = None
+        self.rescan_task : asyncio.Task = None
+        self.stopped : asyncio.Event = None
+
+        # Set once stop is called, so syncs finishing meanwhile schedule no more
+        self.stopping = False
+
+        # Debounce timer of each master file with a pending sync,
+        # and when its first change since the last sync was seen
+        self.timers : dict[MasterFile, asyncio.TimerHandle] = {}
+        self.first_change : dict[MasterFile, float] = {}
+
+        # Syncs in flight, and masters that changed again during theirs
+        self.running : dict[MasterFile, asyncio.Task] = {}
+        self.changed_while_running : set[MasterFile] = set()
+
+        # Kept whether or not metrics are enabled, for status
+        self.syncs_done = 0
+        self.sync_errors = 0
+        self.longest_sync = 0.
+
+    @property
+    def started(self) -> bool:
+        return self.watcher is not None
+
+    async def start(self) -> None:
+
+        if self.started:
+            return
+
+        self.loop = asyncio.get_running_loop()
+        self.stopping = False
+        self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        self.stopped = asyncio.Event()
+
+        self.watcher = make_watcher(poll_interval= self.poll_interval, use_inotify= self.use_inotify)
+        for master_file in self.master_files:
+            self.watcher.watch_master(master_file)
+
+        # inotify wakes the loop itself, polling needs a task
+        if isinstance(self.watcher, InotifyWatcher):
+            self.loop.add_reader(self.watcher.fd, self.check_watcher)
+        self.start_polling()
+
+        if self.discover is not None:
+            self.rescan_task = asyncio.create_task(self.rescan_forever())
+
+    async def stop(self) -> None:
+        """Stop watching, dropping pending syncs and waiting for running ones"""
+
+        if not self.started:
+            return
+
+        # Stopped already by another caller, done once it is
+        if self.stopping:
+            await self.stopped.wait()
+            return
+
+        self.stopping = True
+
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        self.first_change.clear()
+        self.changed_while_running.clear()
+
+        for task in (self.poll_task, self.rescan_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions= True)
+        self.poll_task = None
+        self.rescan_task = None
+
+        if isinstance(self.watcher, InotifyWatcher):
+            self.loop.remove_reader(self.watcher.fd)
+
+        if self.running:
+            await asyncio.gather(*self.running.values(), return_exceptions= True)
+
+        self.watcher.close()
+        self.watcher = None
+        self.stopped.set()
+
+    async def run_forever(self) -> None:
+        """Start, then run until stop is called or the task is cancelled"""
+
+        await self.start()
+        try:
+            await self.stopped.wait()
+        finally:
+            await self.stop()
+
+    async def add(self, master_file : MasterFile) -> None:
+        """Watch another master file, syncing it once straight away"""
+
+        if master_file in self.master_files:
+            return
+
+        self.master_files.append(master_file)
+        if self.started:
+            self.watcher.watch_master(master_file)
+            self.start_polling()
+            self.notice(master_file)
+
+    async def remove(self, master_file : MasterFile) -> None:
+        """Stop watching a master file, after any sync of it that is running"""
+
+        if master_file not in self.master_files:
+            return
+
+        self.master_files.remove(master_file)
+        self.cancel_pending(master_file)
+
+        task = self.running.get(master_file)
+        if task is not None:
+            await asyncio.gather(task, return_exceptions= True)
+
+        if self.started:
+            self.watcher.unwatch_master(master_file)
+
+    def status(self) -> dict:
+        """How busy the service is, and how its syncs have gone so far"""
+
+        return {
+            "master_files": len(self.master_files),
+            "pending": len(self.timers),
+            "running": len(self.running),
+            "syncs": self.syncs_done,
+            "errors": self.sync_errors,
+            "longest_sync_seconds": self.longest_sync
+        }
+
+    async def __aenter__(self) -> SectionerService:
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+    def start_polling(self) -> None:
+        """Start the poll task, if the watcher needs one and it is not running.
+        inotify only needs it for masters it could not watch."""
+
+        if self.poll_task is not None or self.stopping:
+            return
+
+        if not isinstance(self.watcher, InotifyWatcher) or self.watcher.polled_masters:
+            self.poll_task = asyncio.create_task(self.poll())
+
+    async def poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            for master_file in self.watcher.wait(0):
+                self.notice(master_file)
+
+    async def rescan(self) -> None:
+        """Discover master files again, adding the ones not watched yet.
+        Masters that are gone remove themselves when they next sync."""
+
+        found = await self.loop.run_in_executor(None, self.discover)
+
+        known = {master_file.path for master_file in self.master_files}
+        for master_file in found:
+            if master_file.path not in known and not self.stopping:
+                await self.add(master_file)
+
+    async def rescan_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.rescan_interval)
+            try:
+                await self.rescan()
+            except Exception:
+                # Tried again next time
+                traceback.print_exc()
+
+    def check_watcher(self) -> None:
+        if self.watcher is not None:
+            for master_file in self.watcher.wait(0):
+                self.notice(master_file)
+
+            # Section directories it found but could not watch are polled
+            self.start_polling()
+
+    def cancel_pending(self, master_file : MasterFile) -> None:
+
+        timer = self.timers.pop(master_file, None)
+        if timer is not None:
+            timer.cancel()
+        self.first_change.pop(master_file, None)
+        self.changed_while_running.discard(master_file)
+
+    def notice(self, master_file : MasterFile) -> None:
+        """Something about master_file changed, (re)start its debounce timer"""
+
+        if self.stopping or master_file not in self.master_files:
+            return
+
+        # The sync in flight may have read the file before this change
+        if master_file in self.running:
+            self.changed_while_running.add(master_file)
+            return
+
+        now = self.loop.time()
+        first = self.first_change.setdefault(master_file, now)
+        delay = max(0., min(self.debounce, first + self.max_delay - now))
+
+        timer = self.timers.pop(master_file, None)
+        if timer is not None:
+            timer.cancel()
+        self.timers[master_file] = self.loop.call_later(delay, self.start_sync, master_file)
+
+    def start_sync(self, master_file : MasterFile) -> None:
+
+        self.timers.pop(master_file, None)
+        if self.stopping:
+            return
+
+        first = self.first_change.pop(master_file, self.loop.time())
+        self.running[master_file] = asyncio.create_task(self.run_sync(master_file, first))
+
+    async def run_sync(self, master_file : MasterFile, first_change : float) -> None:
+
+        try:
+            async with self.semaphore:
+                sync_start = self.loop.time()
+                exists = await self.loop.run_in_executor(
+                    None, self.sync, master_file, self.use_mmap, self.fsync
+                )
+                self.longest_sync = max(self.longest_sync, self.loop.time() - sync_start)
+        except Exception:
+            # One master failing to sync does not stop the others
+            traceback.print_exc()
+            self.sync_errors += 1
+            exists = True
+        finally:
+            self.syncs_done += 1
+            del self.running[master_file]
+
+        # From the first change noticed to its sync being done, debounce included
+        metrics.record("change_to_sync", self.loop.time() - first_change)
+
+        if not exists:
+            self.cancel_pending(master_file)
+            await self.remove(master_file)
+            return
+
+        # Section directories the sync created are watched from now on
+        if isinstance(self.watcher, InotifyWatcher):
+            self.check_watcher()
+
+        if master_file in self.changed_while_running:
+            self.changed_while_running.discard(master_file)
+            self.notice(master_file)
@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+import pathlib
+import sys
+
+import pytest
+
+# Modules import each other by name, from the project directory
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from file_class import MasterFile
+from instrumentation import metrics
+from sectioner import python_header
+
+@pytest.fixture
+def make_master(tmp_path):
+    """Write content to a master file in tmp_path, returning its MasterFile"""
+
+    def make_master(content : bytes, name : str = "m.py") -> MasterFile:
+        path = tmp_path.joinpath(name)
+        path.write_bytes(content)
+        master_file = MasterFile(path)
+        master_file.section_header = python_header
+        return master_file
+
+    return make_master
+
+@pytest.fixture
+def enabled_metrics():
+    metrics.reset()
+    metrics.enable()
+    yield metrics
+    metrics.disable()
+    metrics.reset()
+
+def header(number : int, description : str, newline : bytes = b"\n") -> bytes:
+    """A python section header line, with the line break after it"""
+    return python_header.generate_header(number, description).encode().replace(b"\n", newline) + newline
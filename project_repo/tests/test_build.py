@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from conftest import header
+from sectioner import build_sections, sections_up_to_date, sync_master_file
+
+build_modes = {
+    "lines": {},
+    "mmap": {"use_mmap": True},
+    "stream": {"stream": True}
+}
+
+@pytest.mark.parametrize("mode", build_modes)
+def test_duplicate_headers_rebuild(make_master, mode):
+    master_file = make_master(header(1, "a") + b"first\n" + header(1, "a") + b"second\n")
+
+    for _ in range(2):
+        build_sections(master_file, **build_modes[mode])
+        # Found again, so the second build does the same work as the first
+        master_file.header_identity = None
+
+    assert os.listdir(master_file.dir_master_sections) == ["1__a.py"]
+    assert master_file.dir_master_sections.joinpath("1__a.py").read_bytes() == b"second"
+
+@pytest.mark.parametrize("mode", build_modes)
+def test_rebuild_keeps_other_files(make_master, mode):
+    master_file = make_master(header(1, "a") + b"first\n" + header(2, "b") + b"second\n")
+    build_sections(master_file, **build_modes[mode])
+
+    sections_dir = master_file.dir_master_sections
+    for name in (".1__a.py.swp", "1__a.py~", "notes.txt"):
+        sections_dir.joinpath(name).write_bytes(b"keep")
+
+    # Section 2 is dropped, and its file with it
+    master_file.path.write_bytes(header(1, "a") + b"changed\n")
+    master_file.header_identity = None
+    build_sections(master_file, **build_modes[mode])
+
+    assert sorted(os.listdir(sections_dir)) == [".1__a.py.swp", "1__a.py", "1__a.py~", "notes.txt"]
+    assert sections_dir.joinpath("1__a.py").read_bytes() == b"changed"
+
+def test_other_files_keep_sections_up_to_date(make_master):
+    master_file = make_master(header(1, "a") + b"code\n")
+    build_sections(master_file)
+    master_file.dir_master_sections.joinpath("1__a.py.orig").write_bytes(b"old")
+
+    assert sections_up_to_date(master_file)
+
+def test_master_gone_keeps_other_files(make_master):
+    master_file = make_master(header(1, "a") + b"code\n")
+    build_sections(master_file)
+    master_file.dir_master_sections.joinpath("notes.txt").write_bytes(b"keep")
+
+    master_file.path.unlink()
+    assert not sync_master_file(master_file)
+
+    assert os.listdir(master_file.dir_master_sections) == ["notes.txt"]
+
+def test_master_gone_removes_sections_dir(make_master):
+    master_file = make_master(header(1, "a") + b"code\n")
+    build_sections(master_file)
+
+    master_file.path.unlink()
+    assert not sync_master_file(master_file)
+
+    assert not master_file.dir_master_sections.exists()
+
+def test_stream_build_reads_master_once(make_master, enabled_metrics):
+    master_file = make_master(header(1, "a") + b"x = 1\n" * 1000 + header(2, "b") + b"y = 2\n")
+
+    build_sections(master_file, stream= True)
+
+    assert enabled_metrics.snapshot()["counters"]["bytes_read"] == os.path.getsize(master_file.path)
+    assert master_file.prev_state[2] is not None
+
+    # Touched but unchanged
+    os.utime(master_file.path, ns= (0, master_file.prev_state[1] + 10**9))
+    assert not master_file.detect_file_change()
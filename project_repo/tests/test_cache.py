@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+import os
+
+from cache import ParseCache, default_cache_path
+from sectioner import build_sections, get_master_files, main, python_header, section_dialects
+
+def test_default_cache_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path.joinpath("cache")))
+    first, second = tmp_path.joinpath("first"), tmp_path.joinpath("second")
+
+    path = default_cache_path([str(first), str(second)])
+
+    assert path.parent == tmp_path.joinpath("cache", "filesectioner")
+    assert default_cache_path([str(second), str(first)]) == path
+    assert default_cache_path([str(first)]) != path
+
+def test_cache_not_written_to_working_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path.joinpath("cache")))
+    tree = tmp_path.joinpath("tree")
+    tree.mkdir()
+    tree.joinpath("m.py").write_text(python_header.generate_header(1, "a") + "\nx = 1\n")
+
+    monkeypatch.chdir(tree)
+    main(["."])
+
+    assert sorted(os.listdir(tree)) == ["m.py", "sections"]
+    assert default_cache_path(["."]).is_file()
+
+def test_warm_start_ignores_touch(tmp_path):
+    master = tmp_path.joinpath("m.py")
+    master.write_text(python_header.generate_header(1, "a") + "\nx = 1\n")
+    cache_path = tmp_path.joinpath("cache")
+
+    cache = ParseCache(cache_path, section_dialects.headers)
+    for master_file in get_master_files([str(tmp_path)], cache= cache):
+        build_sections(master_file)
+        cache.store_master(master_file)
+    cache.save()
+
+    cache = ParseCache(cache_path, section_dialects.headers)
+    cache.load()
+    master_file, = get_master_files([str(tmp_path)], cache= cache)
+    assert master_file.prev_state[2] is not None
+
+    os.utime(master, ns= (0, master.stat().st_mtime_ns + 10**9))
+    assert not master_file.detect_file_change()
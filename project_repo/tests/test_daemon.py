@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import os
+import pathlib
+import queue
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import header
+from daemon import ShardedDaemon, shard_of
+from sectioner import get_master_files
+
+paths = [pathlib.Path(f"/tree/m{index}.py") for index in range(50)]
+
+def test_shard_of_stable():
+    shards = [shard_of(path, 4) for path in paths]
+
+    assert all(0 <= shard < 4 for shard in shards)
+    assert len(set(shards)) == 4
+
+    # The same in a fresh interpreter, whatever its hash seed
+    code = (
+        "import pathlib; from daemon import shard_of; "
+        f"print([shard_of(pathlib.Path(f'/tree/m{{index}}.py'), 4) for index in range({len(paths)})])"
+    )
+    project_dir = pathlib.Path(__file__).resolve().parent.parent
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        env= {**os.environ, "PYTHONPATH": str(project_dir), "PYTHONHASHSEED": "random"},
+        capture_output= True,
+        check= True
+    ).stdout
+
+    assert output.decode().strip() == str(shards)
+
+@pytest.fixture
+def masters(tmp_path):
+    for index in range(6):
+        tmp_path.joinpath(f"m{index}.py").write_bytes(header(1, "a") + f"x = {index}\n".encode())
+    return sorted(get_master_files([str(tmp_path)]), key= lambda master_file: master_file.path)
+
+def unstarted_daemon(master_files, **kwargs) -> ShardedDaemon:
+    """A daemon whose shards are plain queues, to see what it sends them"""
+
+    daemon = ShardedDaemon(master_files, shards= 3, **kwargs)
+    daemon.commands = [queue.Queue() for _ in range(3)]
+    return daemon
+
+def sent(daemon : ShardedDaemon) -> list[tuple[int, str, object]]:
+
+    commands = []
+    for shard, shard_commands in enumerate(daemon.commands):
+        while not shard_commands.empty():
+            commands.append((shard, *shard_commands.get_nowait()))
+    return commands
+
+def test_add_remove_routing(masters):
+    daemon = unstarted_daemon(masters[:3])
+    added = masters[3]
+    shard = shard_of(added.path, 3)
+
+    daemon.add(added)
+    daemon.add(added)
+    assert sent(daemon) == [(shard, "add", added)]
+    assert added.path in daemon.shard_masters[shard]
+
+    daemon.remove(added.path)
+    daemon.remove(added.path)
+    assert sent(daemon) == [(shard, "remove", added.path)]
+    assert added.path not in daemon.shard_masters[shard]
+
+def test_rescan_removes_dropped(masters):
+    found = masters[1:]
+    daemon = unstarted_daemon(masters[:3], discover= lambda: found)
+
+    daemon.rescan()
+
+    commands = sent(daemon)
+    assert (shard_of(masters[0].path, 3), "remove", masters[0].path) in commands
+    assert sorted(command[2].path for command in commands if command[1] == "add") == [m.path for m in masters[3:]]
+    assert sorted(path for shard_masters in daemon.shard_masters for path in shard_masters) == [m.path for m in found]
+
+def started_daemon(master_files) -> ShardedDaemon:
+
+    daemon = ShardedDaemon(master_files, shards= 2, use_inotify= False, health_interval= .1)
+    daemon.start()
+
+    # Every shard reports once it has built its sections
+    deadline = time.monotonic() + 30
+    while None in daemon.latest and time.monotonic() < deadline:
+        daemon.read_reports(timeout= .1)
+    return daemon
+
+def test_dead_shard_restarted(masters):
+    daemon = started_daemon(masters)
+    try:
+        dead = daemon.processes[0]
+        dead.kill()
+        dead.join()
+
+        daemon.check_shards()
+
+        assert daemon.restarts == [1, 0]
+        assert daemon.processes[0] is not dead and daemon.processes[0].is_alive()
+    finally:
+        daemon.stop()
+
+def test_stop_hands_back_master_files(masters):
+    daemon = started_daemon(masters)
+
+    stopped = daemon.stop()
+
+    assert sorted(daemon.stopped) == [0, 1]
+    assert sorted(m.path for m in stopped) == [m.path for m in masters]
+    assert all(m.section_digests for m in stopped)
+    assert not any(process.is_alive() for process in daemon.processes)
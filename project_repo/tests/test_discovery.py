@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import pytest
+
+from discovery import IgnoreRules, iter_candidate_files
+from sectioner import get_master_files, python_header, section_dialects, st_header
+
+def header_names(master_files) -> dict[str, str]:
+    names = {id(python_header): "#", id(st_header): "//"}
+    return {master_file.path.name: names[id(master_file.section_header)] for master_file in master_files}
+
+@pytest.fixture
+def tree(tmp_path):
+    tmp_path.joinpath("a.py").write_text(python_header.generate_header(1, "a") + "\nx = 1\n")
+    tmp_path.joinpath("b.st").write_text(st_header.generate_header(1, "b") + "\ny := 2;\n")
+    # Routed to the // header, so its # header is not looked for
+    tmp_path.joinpath("c.st").write_text(python_header.generate_header(1, "c") + "\nz := 3;\n")
+    return tmp_path
+
+@pytest.mark.parametrize("workers", [None, 2])
+@pytest.mark.parametrize("headers, expected", [
+    (None, {"a.py": "#", "b.st": "//"}),
+    ([python_header], {"a.py": "#"}),
+    ([st_header], {"b.st": "//"}),
+    ([st_header, python_header], {"a.py": "#", "b.st": "//"})
+])
+def test_dialect_routing_with_headers(tree, workers, headers, expected):
+    master_files = get_master_files([str(tree)], headers= headers, workers= workers, dialects= section_dialects)
+    assert header_names(master_files) == expected
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_headers_without_dialects(tree, workers):
+    master_files = get_master_files([str(tree)], headers= [st_header, python_header], workers= workers)
+    assert header_names(master_files) == {"a.py": "#", "b.st": "//", "c.st": "#"}
+
+def test_default_dialects(tree):
+    assert header_names(get_master_files([str(tree)])) == {"a.py": "#", "b.st": "//"}
+
+@pytest.mark.parametrize("pattern, path, is_dir, expected", [
+    # Anchoring, a slash other than a trailing one anchors to the root
+    ("m.py", "m.py", False, True),
+    ("m.py", "a/b/m.py", False, True),
+    ("/m.py", "a/m.py", False, False),
+    ("a/m.py", "a/m.py", False, True),
+    ("a/m.py", "x/a/m.py", False, False),
+    # * stays within a name, ** crosses slashes
+    ("a/*.py", "a/m.py", False, True),
+    ("a/*.py", "a/b/m.py", False, False),
+    ("a/**/m.py", "a/m.py", False, True),
+    ("a/**/m.py", "a/b/c/m.py", False, True),
+    ("**/b/m.py", "a/b/m.py", False, True),
+    ("a/**", "a/b/m.py", False, True),
+    # Directories only, and everything inside them
+    ("b/", "a/b", True, True),
+    ("b/", "a/b", False, False),
+    ("b/", "a/b/m.py", False, True),
+    # Escapes
+    ("\\#lit", "#lit", False, True),
+    ("\\!lit", "!lit", False, True),
+    ("a\\*", "a*", False, True),
+    ("a\\*", "ab", False, False),
+    ("a\\ ", "a ", False, True),
+    ("a ", "a", False, True),
+    ("[\\]]x", "]x", False, True),
+    ("[!a-c]x", "bx", False, False),
+    ("[!a-c]x", "dx", False, True)
+])
+def test_ignore_pattern(pattern, path, is_dir, expected):
+    assert IgnoreRules([pattern]).match(path, is_dir) is expected
+
+def test_ignore_negation_last_wins():
+    rules = IgnoreRules(["*.py", "!keep.py", "# comment", "a/"])
+
+    assert rules.match("m.py", False)
+    assert not rules.match("keep.py", False)
+    assert rules.match("a/keep.py", False)
+    assert not rules.match("#comment", False)
+
+def test_candidates_skip_sections_and_excludes(tmp_path):
+    for relative_path in ["m.py", "sections/m/1__a.py", "a/sections/x.py", "a/n.py", ".git/config", "a/__pycache__/n.pyc"]:
+        path = tmp_path.joinpath(relative_path)
+        path.parent.mkdir(parents= True, exist_ok= True)
+        path.write_text("")
+
+    candidates = sorted(path.relative_to(tmp_path).as_posix() for path in iter_candidate_files([str(tmp_path)]))
+
+    assert candidates == ["a/n.py", "m.py"]
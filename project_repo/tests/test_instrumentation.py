@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import threading
+
+
+from instrumentation import Instrumentation
+from sectioner import get_master_files, python_header
+
+def test_count_from_threads():
+    instrumentation = Instrumentation()
+    instrumentation.enable()
+
+    def work() -> None:
+        for _ in range(10000):
+            instrumentation.count("calls")
+            instrumentation.record("work", .001)
+
+    threads = [threading.Thread(target= work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    snapshot = instrumentation.snapshot()
+    assert snapshot["counters"]["calls"] == 80000
+    assert snapshot["timers"]["work"]["calls"] == 80000
+
+def test_take_and_merge():
+    worker = Instrumentation()
+    worker.enable()
+    worker.count("files_scanned", 3)
+    worker.record("parse", .5)
+
+    parent = Instrumentation()
+    parent.enable()
+    parent.count("files_scanned")
+    parent.record("parse", .25)
+
+    parent.merge(worker.take())
+
+    assert worker.snapshot() == {"counters": {}, "timers": {}}
+    assert parent.snapshot() == {
+        "counters": {"files_scanned": 4},
+        "timers": {"parse": {"calls": 2, "total_seconds": .75, "max_seconds": .5}}
+    }
+
+def test_discovery_workers_counted(tmp_path, enabled_metrics):
+    for index in range(20):
+        tmp_path.joinpath(f"m{index}.py").write_text(python_header.generate_header(1, "a") + "\nx = 1\n")
+
+    counters = []
+    for workers in (None, 2):
+        enabled_metrics.reset()
+        get_master_files([str(tmp_path)], workers= workers)
+        counters.append(enabled_metrics.snapshot()["counters"])
+
+    assert counters[0]["files_scanned"] == 20
+    assert counters[1] == counters[0]
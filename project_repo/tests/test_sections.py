@@ -0,0 +1,34 @@
+from __future__ import annotations
+
+import pytest
+
+from file_class import SectionsSnapshot, is_section_file_name
+
+@pytest.mark.parametrize("name, expected", [
+    ("1__a.py", True),
+    ("-2__a.py", True),
+    ("10__two words.py", True),
+    ("3__a.b.py", True),
+    ("1__a.py~", False),
+    ("1__a.py.orig", False),
+    ("1__a.py.swp.bak", False),
+    (".1__a.py.swp", False),
+    ("01__a.py", False),
+    ("a__b.py", False),
+    ("1_a.py", False),
+    ("1__a.st", False)
+])
+def test_is_section_file_name(name, expected):
+    assert is_section_file_name(name, "py") == expected
+
+def test_snapshot_ignores_other_files(tmp_path):
+    tmp_path.joinpath("1__a.py").write_bytes(b"a")
+    tmp_path.joinpath("1__a.py~").write_bytes(b"backup")
+    tmp_path.joinpath(".1__a.py.swp").write_bytes(b"swap")
+
+    snapshot = SectionsSnapshot()
+    listed, changed = snapshot.refresh(tmp_path, "py")
+
+    assert listed
+    assert changed == ["1__a.py"]
+    assert list(snapshot.entries) == ["1__a.py"]
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+
+from conftest import header
+from service import SectionerService
+
+def test_stop_during_sync(make_master):
+    master_file = make_master(header(1, "a") + b"code\n")
+
+    release = threading.Event()
+    syncing = threading.Event()
+    syncs = []
+
+    def sync(master_file, use_mmap, fsync) -> bool:
+        syncs.append(master_file)
+        syncing.set()
+        release.wait(5)
+        # The master is edited while it syncs, which the watcher reports when it is done
+        if len(syncs) == 1:
+            with open(master_file.path, "ab") as f:
+                f.write(b"more code\n")
+        return True
+
+    async def main() -> None:
+        service = SectionerService(debounce= 0, sync= sync)
+        await service.start()
+        await service.add(master_file)
+
+        await asyncio.get_running_loop().run_in_executor(None, syncing.wait, 5)
+        asyncio.get_running_loop().call_later(.05, release.set)
+        await service.stop()
+
+        assert not service.timers
+        await asyncio.sleep(.1)
+
+    asyncio.run(main())
+    assert len(syncs) == 1
+
+def test_rescan_adds_new_masters(make_master):
+    known = make_master(header(1, "a") + b"code\n", "a.py")
+    found = [known]
+    synced = []
+
+    def sync(master_file, use_mmap, fsync) -> bool:
+        synced.append(master_file.path.name)
+        return True
+
+    async def main() -> None:
+        service = SectionerService(
+            master_files= [known],
+            use_inotify= False,
+            sync= sync,
+            discover= lambda: list(found),
+            rescan_interval= .05
+        )
+
+        async with service:
+            found.append(make_master(header(1, "b") + b"code\n", "b.py"))
+            for _ in range(50):
+                await asyncio.sleep(.02)
+                if "b.py" in synced:
+                    break
+
+            assert [master_file.path.name for master_file in service.master_files] == ["a.py", "b.py"]
+
+    asyncio.run(main())
+    assert "b.py" in synced
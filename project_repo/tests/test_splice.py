@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+import sectioner
+from conftest import header
+from sectioner import build_sections, renumbered, rewrite_master_headers, sync_master_file
+
+def master_content(newline : bytes) -> bytes:
+    return b"".join(
+        header(number, description, newline) + code.replace(b"\n", newline)
+        for number, description, code in (
+            (1, "one", b"a = 1\nb = 2\n"),
+            (2, "two", b"c = 3\n\n"),
+            (3, "three", b"d = 4\n")
+        )
+    )
+
+def edit(path, content : bytes) -> None:
+    """Write a section file as an editor would, with a newer mtime"""
+    stat = os.stat(path)
+    path.write_bytes(content)
+    os.utime(path, ns= (stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+@pytest.fixture(params= [b"\n", b"\r\n"], ids= ["lf", "crlf"])
+def newline(request):
+    return request.param
+
+@pytest.fixture
+def built(make_master, newline):
+    master_file = make_master(master_content(newline))
+    build_sections(master_file)
+    return master_file
+
+def test_splice_in_place(built, newline):
+    inode = os.stat(built.path).st_ino
+
+    edit(built.dir_master_sections.joinpath("2__two.py"), b"c = 9" + newline)
+    assert sync_master_file(built)
+
+    assert built.path.read_bytes() == master_content(newline).replace(b"c = 3", b"c = 9")
+    assert os.stat(built.path).st_ino == inode
+    assert [built.sections[index].section_number for index in range(len(built.sections))] == [1, 2, 3]
+
+def test_splice_resized(built, newline):
+    inode = os.stat(built.path).st_ino
+
+    edit(built.dir_master_sections.joinpath("1__one.py"), b"a = 10" + newline + b"b = 20" + newline)
+    assert sync_master_file(built)
+
+    expected = master_content(newline).replace(b"a = 1" + newline + b"b = 2", b"a = 10" + newline + b"b = 20")
+    assert built.path.read_bytes() == expected
+    assert os.stat(built.path).st_ino != inode
+
+    # The sections found again are those of the new master
+    build_sections(built)
+    assert built.dir_master_sections.joinpath("3__three.py").read_bytes() == b"d = 4"
+
+def test_splice_failure_leaves_master(built, newline, monkeypatch):
+
+    def fail(*args) -> None:
+        raise OSError("disk full")
+
+    monkeypatch.setattr(sectioner, "copy_range", fail)
+    edit(built.dir_master_sections.joinpath("1__one.py"), b"longer than before" + newline)
+
+    with pytest.raises(OSError):
+        sync_master_file(built)
+
+    assert built.path.read_bytes() == master_content(newline)
+    assert sorted(os.listdir(built.path.parent)) == ["m.py", "sections"]
+
+def test_renumber_in_place(built, newline):
+    inode = os.stat(built.path).st_ino
+
+    rewrite_master_headers(built, renumbered(built, start= 4))
+
+    assert built.path.read_bytes() == master_content(newline).replace(b": 1", b": 4").replace(b": 2", b": 5").replace(b": 3", b": 6")
+    assert os.stat(built.path).st_ino == inode
+    assert sorted(os.listdir(built.dir_master_sections)) == ["4__one.py", "5__two.py", "6__three.py"]
+    assert built.dir_master_sections.joinpath("4__one.py").read_bytes() == b"a = 1" + newline + b"b = 2"
+
+def test_renumber_resized(built, newline):
+    inode = os.stat(built.path).st_ino
+
+    rewrite_master_headers(built, {0: (10, None), 2: (None, "last")})
+
+    expected = master_content(newline).replace(b": 1", b": 10").replace(b": three", b": last")
+    assert built.path.read_bytes() == expected
+    assert os.stat(built.path).st_ino != inode
+    assert sorted(os.listdir(built.dir_master_sections)) == ["10__one.py", "2__two.py", "3__last.py"]
+
+def test_renumber_failure_leaves_master(built, newline):
+    inode = os.stat(built.path).st_ino
+
+    # The first change alone could be made in place, the second can not be made at all
+    with pytest.raises(ValueError):
+        rewrite_master_headers(built, {0: (4, None), 1: (None, "two\nlines")})
+
+    assert built.path.read_bytes() == master_content(newline)
+    assert os.stat(built.path).st_ino == inode
+    assert sorted(os.listdir(built.path.parent)) == ["m.py", "sections"]
+
+def test_splice_with_backup_left_by_editor(built, newline):
+    sections_dir = built.dir_master_sections
+
+    # Saved as editors that keep a backup do, renaming the old file aside
+    os.rename(sections_dir.joinpath("1__one.py"), sections_dir.joinpath("1__one.py~"))
+    sections_dir.joinpath("1__one.py").write_bytes(b"EDITED" + newline)
+    sections_dir.joinpath("4__new.py").write_bytes(b"not a section of the master")
+    assert sync_master_file(built)
+
+    assert built.path.read_bytes() == master_content(newline).replace(b"a = 1" + newline + b"b = 2", b"EDITED")
+    assert sections_dir.joinpath("1__one.py").read_bytes() == b"EDITED" + newline
+    assert sorted(os.listdir(sections_dir)) == ["1__one.py", "1__one.py~", "2__two.py", "3__three.py", "4__new.py"]
+
+def test_splice_before_restoring_deleted(built, newline):
+    sections_dir = built.dir_master_sections
+
+    edit(sections_dir.joinpath("2__two.py"), b"c = 9" + newline)
+    sections_dir.joinpath("3__three.py").unlink()
+    assert sync_master_file(built)
+
+    assert built.path.read_bytes() == master_content(newline).replace(b"c = 3", b"c = 9")
+    assert sections_dir.joinpath("2__two.py").read_bytes() == b"c = 9"
+    assert sections_dir.joinpath("3__three.py").read_bytes() == b"d = 4"
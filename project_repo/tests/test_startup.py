@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import os
+import pathlib
+import subprocess
+import sys
+
+# Best of several fresh imports of sectioner, well above the ~30ms it takes
+import_budget_seconds = .15
+
+project_dir = pathlib.Path(__file__).resolve().parent.parent
+
+# Run in a fresh interpreter, with sys.argv made to raise if it is read at all
+import_code = """
+import sys, time
+
+class Untouchable(list):
+    def untouchable(self, *args):
+        raise AssertionError("sys.argv read on import")
+    __getitem__ = __iter__ = __len__ = __contains__ = untouchable
+
+sys.argv = Untouchable(["sectioner", "--not-an-option"])
+
+start = time.perf_counter()
+import sectioner
+print(time.perf_counter() - start)
+"""
+
+def import_sectioner(cwd : pathlib.Path) -> float:
+
+    environment = dict(os.environ, PYTHONPATH= str(project_dir), PYTHONDONTWRITEBYTECODE= "1")
+    output = subprocess.run(
+        [sys.executable, "-c", import_code],
+        cwd= cwd,
+        env= environment,
+        capture_output= True,
+        text= True,
+        check= True
+    ).stdout
+
+    return float(output.split()[-1])
+
+def test_import_is_side_effect_free(tmp_path):
+    import_sectioner(tmp_path)
+    assert os.listdir(tmp_path) == []
+
+def test_import_time(tmp_path):
+    best = min(import_sectioner(tmp_path) for _ in range(5))
+    assert best < import_budget_seconds, f"import sectioner took {best * 1000:.1f}ms"
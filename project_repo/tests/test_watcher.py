@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from conftest import header
+from service import SectionerService
+from watcher import InotifyWatcher, load_inotify
+
+libc = load_inotify()
+needs_inotify = pytest.mark.skipif(libc is None, reason= "inotify is not available")
+
+@pytest.fixture
+def no_watches(monkeypatch):
+    """inotify_add_watch failing as it does once max_user_watches is used up"""
+    monkeypatch.setattr(InotifyWatcher, "add_watch", lambda self, dir: False)
+
+@needs_inotify
+def test_unwatchable_master_is_polled(make_master, no_watches):
+    master_file = make_master(header(1, "a") + b"code\n")
+    master_file.dir_master_sections.mkdir(parents= True)
+
+    watcher = InotifyWatcher(libc, poll_interval= .05)
+    try:
+        watcher.watch_master(master_file)
+        assert watcher.polled_masters == [master_file]
+        assert watcher.wait(1) == {master_file}
+        assert watcher.wait(1) == {master_file}
+
+        watcher.unwatch_master(master_file)
+        assert watcher.polled_masters == []
+    finally:
+        watcher.close()
+
+@needs_inotify
+def test_service_syncs_unwatchable_master(make_master, no_watches):
+    master_file = make_master(header(1, "a") + b"code\n")
+    synced = []
+
+    def sync(master_file, use_mmap, fsync) -> bool:
+        synced.append(master_file)
+        return True
+
+    async def main() -> None:
+        async with SectionerService(master_files= [master_file], debounce= 0, poll_interval= .02, sync= sync) as service:
+            assert isinstance(service.watcher, InotifyWatcher)
+            for _ in range(50):
+                await asyncio.sleep(.02)
+                if synced:
+                    break
+
+    asyncio.run(main())
+    assert synced
@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+
+from file_class import MasterFile
+from instrumentation import metrics
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 1
+# section_description: Inotify
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Whole file writes, editors replacing the file by rename, and deletes
+watch_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+event_header = struct.Struct("iIII")
+
+def load_inotify():
+    """libc with the inotify calls set up, or None where inotify is unavailable"""
+
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno= True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+class InotifyWatcher:
+    """Wakes only when a master file or one of its section files changes.
+
+    Each master's parent directory is watched, rather than the file, so
+    editors that save by writing a new file and renaming it over the old
+    one are still seen. Each master's sections directory is watched too.
+
+    A master whose directories can not be watched, when max_user_watches
+    is used up, is polled instead: wait returns it every poll_interval
+    seconds, and polled_masters lists it for a caller that only calls
+    wait once the fd is readable.
+    """
+
+    def __init__(self, libc, poll_interval : float = .1) -> None:
+
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        self.master_files : list[MasterFile] = []
+
+        # Watch descriptor to watched directory and back
+        self.watch_dirs : dict[int, Path] = {}
+        self.dir_watches : dict[Path, int] = {}
+
+        # Paths, files or directories, that belong to a master
+        self.path_masters : dict[Path, list[MasterFile]] = {}
+
+        # Section directories that do not exist yet or were removed
+        self.unwatched_section_dirs : set[Path] = set()
+
+        # Masters with a directory that exists but could not be watched
+        self.polled_masters : list[MasterFile] = []
+        self.poll_interval = poll_interval
+        self.next_poll = 0.
+
+    def add_watch(self, dir : Path) -> bool:
+
+        if dir in self.dir_watches:
+            return True
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir), watch_mask)
+        if wd < 0:
+            return False
+
+        self.watch_dirs[wd] = dir
+        self.dir_watches[dir] = wd
+        return True
+
+    def remove_watch(self, dir : Path) -> None:
+
+        wd = self.dir_watches.pop(dir, None)
+        if wd is not None:
+            self.watch_dirs.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def watch_master(self, master_file : MasterFile) -> None:
+
+        if master_file in self.master_files:
+            return
+
+        self.master_files.append(master_file)
+
+        for path in (master_file.path, master_file.dir_master_sections):
+            self.path_masters.setdefault(path, []).append(master_file)
+
+        if not self.add_watch(master_file.path.parent):
+            self.poll_master(master_file)
+        if not self.add_watch(master_file.dir_master_sections):
+            self.unwatched_section_dirs.add(master_file.dir_master_sections)
+            if master_file.dir_master_sections.is_dir():
+                self.poll_master(master_file)
+
+    def poll_master(self, master_file : MasterFile) -> None:
+        if master_file not in self.polled_masters:
+            self.polled_masters.append(master_file)
+            metrics.count("masters_polled")
+
+    def unwatch_master(self, master_file : MasterFile) -> None:
+
+        if master_file not in self.master_files:
+            return
+
+        self.master_files.remove(master_file)
+        if master_file in self.polled_masters:
+            self.polled_masters.remove(master_file)
+
+        for path in (master_file.path, master_file.dir_master_sections):
+            masters = self.path_masters.get(path, [])
+            if master_file in masters:
+                masters.remove(master_file)
+            if not masters:
+                self.path_masters.pop(path, None)
+
+        # Parent directories can be shared between masters
+        still_watched = set()
+        for m in self.master_files:
+            still_watched.add(m.path.parent)
+            still_watched.add(m.dir_master_sections)
+
+        for dir in (master_file.path.parent, master_file.dir_master_sections):
+            if dir not in still_watched:
+                self.remove_watch(dir)
+                self.unwatched_section_dirs.discard(dir)
+
+    def read_events(self) -> set[MasterFile]:
+
+        changed : set[MasterFile] = set()
+
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            if not buffer:
+                break
+
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, _, name_length = event_header.unpack_from(buffer, offset)
+                offset += event_header.size
+                name = buffer[offset : offset + name_length].rstrip(b"\0")
+                offset += name_length
+
+                # Events were dropped, everything has to be checked
+                if mask & IN_Q_OVERFLOW:
+                    changed.update(self.master_files)
+                    continue
+
+                dir = self.watch_dirs.get(wd)
+                if dir is None:
+                    continue
+
+                # A removed sections directory is watched again once it is rebuilt
+                if mask & IN_IGNORED:
+                    self.watch_dirs.pop(wd, None)
+                    self.dir_watches.pop(dir, None)
+                    if dir in self.path_masters:
+                        self.unwatched_section_dirs.add(dir)
+                    changed.update(self.path_masters.get(dir, []))
+                    continue
+
+                # Something in a sections directory changed
+                changed.update(self.path_masters.get(dir, []))
+
+                # A master file, or a sections directory, changed in a parent directory
+                if name:
+                    changed.update(self.path_masters.get(dir.joinpath(os.fsdecode(name)), []))
+
+        return changed
+
+    def wait(self, timeout : float = None) -> set[MasterFile]:
+        """Block until something changes, returning the master files to check"""
+
+        changed : set[MasterFile] = set()
+
+        # Section directories created since the last call are watched now,
+        # and their masters checked in case something was missed meanwhile
+        for dir in list(self.unwatched_section_dirs):
+            if self.add_watch(dir):
+                self.unwatched_section_dirs.discard(dir)
+                for master_file in self.path_masters.get(dir, []):
+                    changed.add(master_file)
+                    if master_file in self.polled_masters and master_file.path.parent in self.dir_watches:
+                        self.polled_masters.remove(master_file)
+            elif dir.is_dir():
+                for master_file in self.path_masters.get(dir, []):
+                    self.poll_master(master_file)
+
+        if self.polled_masters:
+            now = time.monotonic()
+            if now >= self.next_poll:
+                self.next_poll = now + self.poll_interval
+                changed.update(self.polled_masters)
+            timeout = self.next_poll - now if timeout is None else min(timeout, max(0., self.next_poll - now))
+
+        if changed:
+            return changed | self.read_events()
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            changed = self.read_events()
+        elif self.polled_masters and time.monotonic() >= self.next_poll:
+            self.next_poll = time.monotonic() + self.poll_interval
+            changed = set(self.polled_masters)
+
+        return changed
+
+    def close(self) -> None:
+
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~+
+# section_number     : 2
+# section_description: Polling
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~-
+
+class PollingWatcher:
+    """Checks every master file on a fixed interval, where inotify is unavailable"""
+
+    def __init__(self, poll_interval : float = .1) -> None:
+        self.poll_interval = poll_interval
+        self.master_files : list[MasterFile] = []
+
+    def watch_master(self, master_file : MasterFile) -> None:
+        if master_file not in self.master_files:
+            self.master_files.append(master_file)
+
+    def unwatch_master(self, master_file : MasterFile) -> None:
+        if master_file in self.master_files:
+            self.master_files.remove(master_file)
+
+    def wait(self, timeout : float = None) -> set[MasterFile]:
+
+        if timeout is not None and timeout < self.poll_interval:
+            time.sleep(timeout)
+        else:
+            time.sleep(self.poll_interval)
+
+        return set(self.master_files)
+
+    def close(self) -> None:
+        pass
+
+def make_watcher(poll_interval : float = .1, use_inotify : bool = True) -> InotifyWatcher | PollingWatcher:
+    """inotify where available, otherwise the polling fallback"""
+
+    if use_inotify:
+        libc = load_inotify()
+        if libc is not None:
+            try:
+                return InotifyWatcher(libc, poll_interval= poll_interval)
+            except OSError:
+                pass
+
+    return PollingWatcher(poll_interval= poll_interval)